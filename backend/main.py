@@ -10,27 +10,51 @@ Provides endpoints for:
 
 import asyncio
 import base64
+import binascii
+import hashlib
 import io
-import json
+import itertools
 import logging
-import subprocess
+import os
+import random
+import re
 import tempfile
+import time
 import zipfile
-from pathlib import Path
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple, Optional
 
 logger = logging.getLogger("product-fairy")
 
+import diskcache
 import httpx
+import orjson
 import pandas as pd
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from google import genai
 from google.genai import types
+from PIL import Image
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown."""
+    # One pooled HTTP/2 client for all Shopify calls, so connections (and their
+    # multiplexed streams) are reused across requests
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=60.0, pool=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    yield
+    await app.state.http.aclose()
+
 
-app = FastAPI(title="Product Image Generator API")
+app = FastAPI(title="Product Image Generator API", lifespan=lifespan)
 
 # CORS for frontend
 app.add_middleware(
@@ -45,6 +69,37 @@ app.add_middleware(
 GEMINI_MODEL = "gemini-2.5-flash-image"
 GEMINI_TEXT_MODEL = "gemini-2.5-flash"
 
+# Max concurrent Gemini image requests per generation run
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+
+# Optional cap on Gemini image requests per minute for each API key
+# (0 = no limit beyond GEMINI_CONCURRENCY)
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "0"))
+
+# Upper bound (seconds) on the jittered backoff between Gemini retries
+GEMINI_MAX_BACKOFF = 30.0
+
+# Gemini clients are reused across requests (keeps their connection pools warm),
+# keyed by a hash of the API key so raw keys aren't kept as cache keys.
+GEMINI_CLIENT_CACHE_SIZE = 32
+_gemini_clients: "OrderedDict[str, genai.Client]" = OrderedDict()
+# Clients currently held by a request -> number of holders. An evicted client
+# is closed once its last holder releases it.
+_gemini_client_leases: Dict[genai.Client, int] = {}
+
+# GEMINI_RPM token buckets, one per API key (Gemini quotas are per key), keyed
+# and bounded the same way as the clients
+_gemini_rate_limiters: "OrderedDict[str, RateLimiter]" = OrderedDict()
+
+# Server-Sent Events response settings
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+SSE_KEEPALIVE_INTERVAL = 15.0  # seconds of silence before a keep-alive comment is sent
+SSE_KEEPALIVE_COMMENT = b": ping\n\n"
+
 # Supported file types for store builder
 SUPPORTED_IMAGE_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/gif", "image/webp"}
 SUPPORTED_DOC_TYPES = {"application/pdf", "text/plain"}
@@ -61,8 +116,173 @@ REQUIRED_COLUMNS = [
     "FlatLayPrompt",
 ]
 
-# In-memory storage for generated images (session-based)
-generated_images: Dict[str, dict] = {}
+# Valid product numbers start with CNC-P (matched from the start of the value)
+PRODUCT_NUMBER_RE = re.compile(r"CNC-P")
+
+# Filenames drop the dashes from product numbers
+STRIP_DASHES = str.maketrans("", "", "-")
+
+# GenderCode -> prompt wording
+GENDER_MAP = {"M": "men's", "W": "women's", "U": "unisex"}
+
+# On-disk cache of generated images (raw bytes), keyed by "<session_id>/<filename>"
+# and tagged with the session id so a session's images can be evicted together.
+# Each session also keeps an index of its filenames so they can be listed without
+# scanning every key in the cache. The cache is blocking SQLite/file I/O, so async
+# code calls these helpers through asyncio.to_thread.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "product-fairy-images"))
+IMAGE_CACHE_SIZE_LIMIT = 2 * 1024 ** 3  # 2GB
+IMAGE_CACHE_TTL = 24 * 60 * 60  # 24 hours
+DEFAULT_SESSION_ID = "default"
+
+image_cache = diskcache.Cache(IMAGE_CACHE_DIR, size_limit=IMAGE_CACHE_SIZE_LIMIT)
+
+
+def get_session_id(x_session_id: Optional[str] = Header(default=None)) -> str:
+    """Resolve the caller's session from the X-Session-Id header."""
+    return (x_session_id or "").strip() or DEFAULT_SESSION_ID
+
+
+def _session_index_key(session_id: str) -> tuple[str, str]:
+    return ("session-index", session_id)
+
+
+def store_image(session_id: str, filename: str, image_info: dict) -> None:
+    """Save a generated image for a session."""
+    index_key = _session_index_key(session_id)
+    with image_cache.transact():
+        image_cache.set(f"{session_id}/{filename}", image_info, expire=IMAGE_CACHE_TTL, tag=session_id)
+        filenames = image_cache.get(index_key, [])
+        if filename not in filenames:
+            filenames.append(filename)
+        image_cache.set(index_key, filenames, expire=IMAGE_CACHE_TTL, tag=session_id)
+
+
+def load_image(session_id: str, filename: str) -> Optional[dict]:
+    """Fetch a session's generated image, or None if missing or expired."""
+    return image_cache.get(f"{session_id}/{filename}")
+
+
+def iter_session_images(session_id: str) -> Iterator[tuple[str, dict]]:
+    """Yield (filename, image_info) for every cached image in a session, loading one at a time."""
+    for filename in image_cache.get(_session_index_key(session_id), []):
+        image_info = load_image(session_id, filename)
+        if image_info is not None:
+            yield filename, image_info
+
+
+def clear_session_images(session_id: str) -> None:
+    """Drop all cached images for a session."""
+    image_cache.evict(session_id)
+
+
+def _gemini_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def acquire_gemini_client(api_key: str) -> genai.Client:
+    """Return a shared Gemini client for this API key, creating it on first use.
+
+    Pair every call with release_gemini_client once the request is done with it.
+    """
+    key_hash = _gemini_key_hash(api_key)
+    client = _gemini_clients.get(key_hash)
+    if client is not None:
+        _gemini_clients.move_to_end(key_hash)
+    else:
+        client = _gemini_clients[key_hash] = genai.Client(api_key=api_key)
+        if len(_gemini_clients) > GEMINI_CLIENT_CACHE_SIZE:
+            _, evicted = _gemini_clients.popitem(last=False)
+            if evicted not in _gemini_client_leases:
+                evicted.close()
+
+    _gemini_client_leases[client] = _gemini_client_leases.get(client, 0) + 1
+    return client
+
+
+def release_gemini_client(client: genai.Client) -> None:
+    """Release a client from acquire_gemini_client, closing it if it was evicted and is now unused."""
+    holders = _gemini_client_leases.pop(client) - 1
+    if holders:
+        _gemini_client_leases[client] = holders
+    elif client not in _gemini_clients.values():
+        client.close()
+
+
+class RateLimiter:
+    """Async token bucket.
+
+    Allows bursts of up to ``capacity`` calls and refills at ``refill_rate``
+    tokens per second. Callers only wait when the bucket is empty.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None  # created lazily inside the running loop
+
+    async def acquire(self, cost: float = 1.0) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_rate)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+                await asyncio.sleep((cost - self._tokens) / self.refill_rate)
+
+    def sync(self, tokens: float, capacity: Optional[float] = None, refill_rate: Optional[float] = None) -> None:
+        """Reset the bucket from an authoritative source, e.g. a server's throttle report."""
+        if capacity:
+            self.capacity = capacity
+        if refill_rate:
+            self.refill_rate = refill_rate
+        self._tokens = min(self.capacity, tokens)
+        self._updated = time.monotonic()
+
+
+def get_gemini_rate_limiter(api_key: str) -> Optional[RateLimiter]:
+    """Return the GEMINI_RPM limiter for this API key (None when GEMINI_RPM is off)."""
+    if GEMINI_RPM <= 0:
+        return None
+
+    key_hash = _gemini_key_hash(api_key)
+    limiter = _gemini_rate_limiters.get(key_hash)
+    if limiter is not None:
+        _gemini_rate_limiters.move_to_end(key_hash)
+        return limiter
+
+    limiter = _gemini_rate_limiters[key_hash] = RateLimiter(
+        capacity=GEMINI_CONCURRENCY, refill_rate=GEMINI_RPM / 60,
+    )
+    if len(_gemini_rate_limiters) > GEMINI_CLIENT_CACHE_SIZE:
+        _gemini_rate_limiters.popitem(last=False)
+    return limiter
+
+
+# CSV column -> internal product field
+PRODUCT_FIELDS = {
+    "ProductNumber": "product_number",
+    "GenderCode": "gender_code",
+    "ColorCode": "color_code",
+    "ProductName": "product_name",
+    "ColorName": "color_name",
+    "FlatLayPrompt": "prompt",
+}
+
+
+def read_products_csv(source) -> pd.DataFrame:
+    """Parse a product CSV, reading only the required columns, all as strings.
+
+    Columns are selected with a callable so a missing column is reported by
+    validate_csv_content rather than raised by the parser.
+    """
+    return pd.read_csv(source, usecols=lambda column: column in REQUIRED_COLUMNS, dtype=str)
 
 
 def validate_csv_content(df: pd.DataFrame) -> dict:
@@ -76,28 +296,23 @@ def validate_csv_content(df: pd.DataFrame) -> dict:
         errors.append(f"Missing required columns: {', '.join(missing_columns)}")
         return {"valid": False, "errors": errors, "warnings": warnings}
 
-    # Count valid products
-    valid_products = []
-    for index, row in df.iterrows():
-        # Check for valid product number
-        product_number = row.get("ProductNumber")
-        if pd.isna(product_number) or not str(product_number).startswith("CNC-P"):
-            continue
-
-        # Check for prompt
-        prompt = row.get("FlatLayPrompt")
-        if pd.isna(prompt) or not str(prompt).strip():
-            warnings.append(f"Row {index + 1}: Missing FlatLayPrompt for {product_number}")
-            continue
-
-        valid_products.append({
-            "product_number": str(row["ProductNumber"]).strip(),
-            "gender_code": str(row.get("GenderCode", "U")).strip(),
-            "color_code": str(row.get("ColorCode", "")).strip(),
-            "product_name": str(row.get("ProductName", "")).strip(),
-            "color_name": str(row.get("ColorName", "")).strip(),
-            "prompt": str(row["FlatLayPrompt"]).strip(),
-        })
+    # Rows need a CNC-P product number and a non-blank prompt
+    product_numbers = df["ProductNumber"]
+    prompts = df["FlatLayPrompt"]
+    has_product_number = product_numbers.astype("string").str.match(PRODUCT_NUMBER_RE, na=False)
+    has_prompt = prompts.notna() & prompts.astype(str).str.strip().ne("")
+
+    for index in df.index[has_product_number & ~has_prompt]:
+        warnings.append(f"Row {index + 1}: Missing FlatLayPrompt for {product_numbers[index]}")
+
+    valid_rows = (
+        df.loc[has_product_number & has_prompt, REQUIRED_COLUMNS]
+        .fillna({"GenderCode": "U"})
+        .fillna("")
+        .astype(str)
+        .apply(lambda column: column.str.strip())
+    )
+    valid_products = valid_rows.rename(columns=PRODUCT_FIELDS).to_dict("records")
 
     if not valid_products:
         errors.append("No valid products found. ProductNumber must start with 'CNC-P' and have a FlatLayPrompt.")
@@ -118,8 +333,8 @@ async def validate_csv(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="File must be a CSV")
 
     try:
-        contents = await file.read()
-        df = pd.read_csv(io.BytesIO(contents))
+        # Parse straight from the upload's spooled temp file, no in-memory copy
+        df = read_products_csv(file.file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to parse CSV: {str(e)}")
 
@@ -147,40 +362,56 @@ async def validate_csv(file: UploadFile = File(...)):
 
 def create_filename(product_number: str, gender_code: str, color_code: str) -> str:
     """Create filename from ProductNumber + GenderCode + ColorCode, removing dashes."""
-    clean_product_number = product_number.replace("-", "")
+    clean_product_number = product_number.translate(STRIP_DASHES)
     return f"{clean_product_number}{gender_code}{color_code}"
 
 
 def convert_png_to_jpg(png_data: bytes) -> Optional[bytes]:
-    """Convert PNG bytes to JPG using ffmpeg."""
+    """Convert PNG bytes to JPG in memory using Pillow."""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as png_file:
-            png_file.write(png_data)
-            png_path = png_file.name
+        jpg_buffer = io.BytesIO()
+        Image.open(io.BytesIO(png_data)).convert("RGB").save(jpg_buffer, format="JPEG", quality=90)
+        return jpg_buffer.getvalue()
+    except Exception:
+        return None
 
-        jpg_path = png_path.replace(".png", ".jpg")
 
-        subprocess.run(
-            ["ffmpeg", "-i", png_path, "-q:v", "2", "-y", jpg_path],
-            capture_output=True,
-            check=True,
-        )
-
-        with open(jpg_path, "rb") as f:
-            jpg_data = f.read()
+def _first_image_bytes(
+    client: genai.Client,
+    contents: List[types.Content],
+    config: types.GenerateContentConfig,
+) -> Optional[bytes]:
+    """Run a blocking image generation request and return the first image part.
 
-        # Cleanup temp files
-        Path(png_path).unlink(missing_ok=True)
-        Path(jpg_path).unlink(missing_ok=True)
+    Stops reading the stream as soon as image data arrives instead of waiting
+    for any trailing text chunks.
+    """
+    stream = client.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=contents,
+        config=config,
+    )
+    try:
+        for chunk in stream:
+            if (
+                chunk.candidates is None
+                or chunk.candidates[0].content is None
+                or chunk.candidates[0].content.parts is None
+            ):
+                continue
 
-        return jpg_data
-    except Exception:
+            part = chunk.candidates[0].content.parts[0]
+            if part.inline_data and part.inline_data.data:
+                return part.inline_data.data
         return None
+    finally:
+        stream.close()
 
 
 async def generate_single_image(
     client: genai.Client,
     prompt: str,
+    rate_limiter: Optional[RateLimiter] = None,
     max_retries: int = 3,
 ) -> tuple[Optional[bytes], Optional[str]]:
     """Generate a single product image.
@@ -201,34 +432,20 @@ async def generate_single_image(
                 response_modalities=["IMAGE", "TEXT"],
             )
 
-            # Run in executor since the SDK is synchronous
-            loop = asyncio.get_event_loop()
-            response_chunks = await loop.run_in_executor(
-                None,
-                lambda: list(client.models.generate_content_stream(
-                    model=GEMINI_MODEL,
-                    contents=contents,
-                    config=generate_content_config,
-                ))
-            )
+            if rate_limiter:
+                await rate_limiter.acquire()
 
-            # Process response chunks
-            for chunk in response_chunks:
-                if (
-                    chunk.candidates is None
-                    or chunk.candidates[0].content is None
-                    or chunk.candidates[0].content.parts is None
-                ):
-                    continue
+            # Run in a worker thread since the SDK is synchronous
+            png_data = await asyncio.to_thread(
+                _first_image_bytes, client, contents, generate_content_config,
+            )
 
-                part = chunk.candidates[0].content.parts[0]
-                if part.inline_data and part.inline_data.data:
-                    png_data = part.inline_data.data
-                    jpg_data = convert_png_to_jpg(png_data)
-                    if jpg_data:
-                        return jpg_data, "image/jpeg", None
-                    # If conversion failed, return PNG
-                    return png_data, "image/png", None
+            if png_data:
+                jpg_data = await asyncio.to_thread(convert_png_to_jpg, png_data)
+                if jpg_data:
+                    return jpg_data, "image/jpeg", None
+                # If conversion failed, return PNG
+                return png_data, "image/png", None
 
             # Stream completed but no image data was found
             last_error = "No image data in API response"
@@ -236,7 +453,8 @@ async def generate_single_image(
         except Exception as e:
             last_error = str(e)
             if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 2
+                # Full jitter keeps concurrent retries from hitting the API in lockstep
+                wait_time = random.uniform(0, min((2 ** attempt) * 2, GEMINI_MAX_BACKOFF))
                 await asyncio.sleep(wait_time)
             continue
 
@@ -248,6 +466,7 @@ async def generate_single_image_with_reference(
     prompt: str,
     reference_image: Optional[bytes] = None,
     reference_mime_type: str = "image/jpeg",
+    rate_limiter: Optional[RateLimiter] = None,
     max_retries: int = 3,
 ) -> tuple[Optional[bytes], Optional[str], Optional[str]]:
     """Generate an image, optionally using a reference image for color consistency.
@@ -267,36 +486,25 @@ async def generate_single_image_with_reference(
                 response_modalities=["IMAGE", "TEXT"],
             )
 
-            loop = asyncio.get_event_loop()
-            response_chunks = await loop.run_in_executor(
-                None,
-                lambda: list(client.models.generate_content_stream(
-                    model=GEMINI_MODEL,
-                    contents=contents,
-                    config=generate_content_config,
-                ))
+            if rate_limiter:
+                await rate_limiter.acquire()
+
+            png_data = await asyncio.to_thread(
+                _first_image_bytes, client, contents, generate_content_config,
             )
 
-            for chunk in response_chunks:
-                if (
-                    chunk.candidates is None
-                    or chunk.candidates[0].content is None
-                    or chunk.candidates[0].content.parts is None
-                ):
-                    continue
-                part = chunk.candidates[0].content.parts[0]
-                if part.inline_data and part.inline_data.data:
-                    png_data = part.inline_data.data
-                    jpg_data = convert_png_to_jpg(png_data)
-                    if jpg_data:
-                        return jpg_data, "image/jpeg", None
-                    return png_data, "image/png", None
+            if png_data:
+                jpg_data = await asyncio.to_thread(convert_png_to_jpg, png_data)
+                if jpg_data:
+                    return jpg_data, "image/jpeg", None
+                return png_data, "image/png", None
 
             last_error = "No image data in API response"
         except Exception as e:
             last_error = str(e)
             if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 2
+                # Full jitter keeps concurrent retries from hitting the API in lockstep
+                wait_time = random.uniform(0, min((2 ** attempt) * 2, GEMINI_MAX_BACKOFF))
                 await asyncio.sleep(wait_time)
             continue
 
@@ -305,98 +513,185 @@ async def generate_single_image_with_reference(
 
 def group_products_by_number(products: List[dict]) -> List[List[dict]]:
     """Group products by product_number, preserving insertion order."""
-    from collections import OrderedDict
-    groups: OrderedDict[str, List[dict]] = OrderedDict()
+    groups: Dict[str, List[dict]] = defaultdict(list)
     for p in products:
-        key = p["product_number"]
-        groups.setdefault(key, []).append(p)
+        groups[p["product_number"]].append(p)
     return list(groups.values())
 
 
-async def generate_images_stream(api_key: str, products: List[dict]):
+def sse_event(payload: dict) -> bytes:
+    """Serialize a payload as a Server-Sent Events data frame."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+async def with_keepalive(stream: AsyncIterator, interval: float = SSE_KEEPALIVE_INTERVAL):
+    """Forward an SSE stream, sending a comment frame whenever it has been idle for `interval` seconds.
+
+    Keeps proxies from dropping the connection while a long Gemini or Shopify
+    call is in flight. The pending item is awaited in a task rather than with
+    a timeout so the wrapped generator is never cancelled by the timer.
+    """
+    iterator = stream.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield SSE_KEEPALIVE_COMMENT
+                continue
+            try:
+                item = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                return
+            pending = None
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        await iterator.aclose()
+
+
+def sse_response(stream: AsyncIterator) -> StreamingResponse:
+    """Wrap an SSE event generator in a streaming response with keep-alive pings."""
+    return StreamingResponse(
+        with_keepalive(stream),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+async def _image_result_event(
+    session_id: str,
+    product: dict,
+    filename: str,
+    image_data: Optional[bytes],
+    gen_error: Optional[str],
+) -> bytes:
+    """Store a generated image (if any) and build the matching SSE event."""
+    if not image_data:
+        error_detail = f"Failed to generate image for {filename}: {gen_error}" if gen_error else f"Failed to generate image for {filename}"
+        return sse_event({'type': 'error', 'message': error_detail})
+
+    await asyncio.to_thread(store_image, session_id, filename, {
+        "data": image_data,
+        "product_name": product["product_name"],
+        "color_name": product["color_name"],
+        "filename": filename,
+    })
+
+    # base64 is only needed for the SSE wire format
+    image_b64 = base64.b64encode(image_data).decode("utf-8")
+    return sse_event({'type': 'image', 'filename': filename, 'productName': product['product_name'], 'colorName': product['color_name'], 'productNumber': product['product_number'], 'genderCode': product['gender_code'], 'colorCode': product['color_code'], 'prompt': product['prompt'], 'data': image_b64})
+
+
+async def generate_images_stream(api_key: str, products: List[dict], session_id: str):
     """Generator that yields SSE events for image generation progress.
 
     Groups products by product_number for color consistency: the first color
     variant generates normally and becomes the reference image, subsequent
     variants of the same product receive the reference image so Gemini can
     recreate the same product in a different color.
+
+    Each group's variant chain runs as its own task, so groups are generated
+    concurrently (bounded by GEMINI_CONCURRENCY per request) and results are
+    streamed as they finish rather than group by group.
     """
-    global generated_images
-    generated_images.clear()
+    await asyncio.to_thread(clear_session_images, session_id)
 
     try:
-        client = genai.Client(api_key=api_key)
+        client = acquire_gemini_client(api_key)
     except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'message': f'Failed to initialize API: {str(e)}'})}\n\n"
+        yield sse_event({'type': 'error', 'message': f'Failed to initialize API: {str(e)}'})
         return
 
-    total = len(products)
-    groups = group_products_by_number(products)
-
-    counter = 0
-    for group in groups:
-        reference_image_bytes: Optional[bytes] = None
-        reference_mime: str = "image/jpeg"
-
-        for j, product in enumerate(group):
-            counter += 1
-            filename = create_filename(
-                product["product_number"],
-                product["gender_code"],
-                product["color_code"],
-            )
+    try:
+        rate_limiter = get_gemini_rate_limiter(api_key)
 
-            yield f"data: {json.dumps({'type': 'progress', 'current': counter, 'total': total, 'product': product['product_name'], 'filename': filename})}\n\n"
+        total = len(products)
+        groups = group_products_by_number(products)
+        counter = 0
+        generated_filenames = set()
 
-            # First in group: generate normally. Subsequent: use reference image.
-            is_variant = j > 0 and reference_image_bytes is not None
-            prompt = product["prompt"]
+        semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+        results: asyncio.Queue = asyncio.Queue()
 
-            if is_variant:
+        async def generate_variant(product: dict, reference: Optional[tuple[bytes, str]]):
+            if reference:
                 # Shorter prompt focused on color change
+                reference_image_bytes, reference_mime = reference
                 color_name = product.get("color_name", "")
-                prompt = f"{prompt}. Generate the exact same product design but in {color_name} color."
-                image_data, mime_type, gen_error = await generate_single_image_with_reference(
-                    client, prompt, reference_image_bytes, reference_mime
-                )
-            else:
-                image_data, mime_type, gen_error = await generate_single_image(client, prompt)
-
-            if image_data:
-                # Store the first successful image as reference for the group
-                if j == 0:
-                    reference_image_bytes = image_data
-                    reference_mime = mime_type or "image/jpeg"
-
-                image_b64 = base64.b64encode(image_data).decode("utf-8")
-                generated_images[filename] = {
-                    "data": image_b64,
-                    "product_name": product["product_name"],
-                    "color_name": product["color_name"],
-                    "filename": filename,
-                }
-
-                yield f"data: {json.dumps({'type': 'image', 'filename': filename, 'productName': product['product_name'], 'colorName': product['color_name'], 'productNumber': product['product_number'], 'genderCode': product['gender_code'], 'colorCode': product['color_code'], 'prompt': product['prompt'], 'data': image_b64})}\n\n"
+                prompt = f"{product['prompt']}. Generate the exact same product design but in {color_name} color."
+                async with semaphore:
+                    image_data, mime_type, gen_error = await generate_single_image_with_reference(
+                        client, prompt, reference_image_bytes, reference_mime, rate_limiter,
+                    )
             else:
-                error_detail = f"Failed to generate image for {filename}: {gen_error}" if gen_error else f"Failed to generate image for {filename}"
-                yield f"data: {json.dumps({'type': 'error', 'message': error_detail})}\n\n"
+                async with semaphore:
+                    image_data, mime_type, gen_error = await generate_single_image(client, product["prompt"], rate_limiter)
+            results.put_nowait((product, image_data, gen_error))
+            return image_data, mime_type
+
+        async def generate_group(group: List[dict]) -> None:
+            image_data, mime_type = await generate_variant(group[0], None)
+            # The first successful image becomes the reference for the group
+            reference = (image_data, mime_type or "image/jpeg") if image_data else None
+            await asyncio.gather(*(generate_variant(product, reference) for product in group[1:]))
+
+        async def generate_all_groups() -> None:
+            try:
+                outcomes = await asyncio.gather(*(generate_group(group) for group in groups), return_exceptions=True)
+                for outcome in outcomes:
+                    if isinstance(outcome, Exception):
+                        logger.warning("[generate] Product group failed: %s", outcome)
+            finally:
+                results.put_nowait(None)  # end of stream
+
+        runner = asyncio.create_task(generate_all_groups())
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                product, image_data, gen_error = result
+                counter += 1
+                filename = create_filename(
+                    product["product_number"],
+                    product["gender_code"],
+                    product["color_code"],
+                )
 
-            if counter < total:
-                await asyncio.sleep(1)
+                progress_event = sse_event({'type': 'progress', 'current': counter, 'total': total, 'product': product['product_name'], 'filename': filename})
 
-    yield f"data: {json.dumps({'type': 'complete', 'total': len(generated_images)})}\n\n"
+                if image_data:
+                    generated_filenames.add(filename)
+
+                # Progress and result are ready together, so send them in one write
+                yield progress_event + await _image_result_event(session_id, product, filename, image_data, gen_error)
+            await runner
+        finally:
+            # Client disconnected or generation aborted: stop outstanding requests
+            runner.cancel()
+
+        yield sse_event({'type': 'complete', 'total': len(generated_filenames)})
+    finally:
+        release_gemini_client(client)
 
 
 @app.post("/api/generate")
 async def generate_images(
     api_key: str = Form(...),
     file: UploadFile = File(...),
+    session_id: str = Depends(get_session_id),
 ):
     """Generate images from CSV with SSE progress streaming."""
     # Parse CSV
     try:
-        contents = await file.read()
-        df = pd.read_csv(io.BytesIO(contents))
+        # Parse straight from the upload's spooled temp file, no in-memory copy
+        df = read_products_csv(file.file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to parse CSV: {str(e)}")
 
@@ -407,34 +702,52 @@ async def generate_images(
 
     products = validation["products"]
 
-    return StreamingResponse(
-        generate_images_stream(api_key, products),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    return sse_response(generate_images_stream(api_key, products, session_id))
+
+
+class _ZipStreamSink:
+    """Write-only file object that buffers ZipFile output until drained."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(images: Iterable[tuple[str, dict]]):
+    """Yield a ZIP archive of the given (filename, image_info) pairs chunk by chunk, one file at a time."""
+    sink = _ZipStreamSink()
+    # JPEGs are already compressed; deflate would burn CPU for no size gain
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zip_file:
+        for filename, image_info in images:
+            zip_file.writestr(f"{filename}.jpg", image_info["data"])
+            yield sink.drain()
+    # Central directory is written on close
+    yield sink.drain()
 
 
+# The download endpoints are plain functions so FastAPI runs their blocking cache
+# reads in its threadpool (and iterates the ZIP stream there too)
 @app.get("/api/download-all")
-async def download_all():
+def download_all(session_id: str = Depends(get_session_id)):
     """Download all generated images as a ZIP file."""
-    if not generated_images:
+    images = iter_session_images(session_id)
+    first = next(images, None)
+    if first is None:
         raise HTTPException(status_code=404, detail="No images to download")
 
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for filename, image_info in generated_images.items():
-            image_data = base64.b64decode(image_info["data"])
-            zip_file.writestr(f"{filename}.jpg", image_data)
-
-    zip_buffer.seek(0)
-
     return StreamingResponse(
-        zip_buffer,
+        iter_zip(itertools.chain([first], images)),
         media_type="application/zip",
         headers={
             "Content-Disposition": "attachment; filename=generated_images.zip"
@@ -443,15 +756,14 @@ async def download_all():
 
 
 @app.get("/api/download/{filename}")
-async def download_single(filename: str):
+def download_single(filename: str, session_id: str = Depends(get_session_id)):
     """Download a single generated image."""
-    if filename not in generated_images:
+    image_info = load_image(session_id, filename)
+    if image_info is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    image_data = base64.b64decode(generated_images[filename]["data"])
-
-    return StreamingResponse(
-        io.BytesIO(image_data),
+    return Response(
+        content=image_info["data"],
         media_type="image/jpeg",
         headers={
             "Content-Disposition": f"attachment; filename={filename}.jpg"
@@ -539,12 +851,11 @@ async def process_uploaded_files(files: List[UploadFile]) -> List[types.Part]:
     """Process uploaded files into Gemini-compatible parts."""
     parts = []
 
-    for file in files[:MAX_FILES]:
-        if not file.filename:
-            continue
-
-        content = await file.read()
+    # Uploads are independent, so read them all at once
+    named_files = [file for file in files[:MAX_FILES] if file.filename]
+    contents = await asyncio.gather(*(file.read() for file in named_files))
 
+    for file, content in zip(named_files, contents):
         # Check file size
         if len(content) > MAX_FILE_SIZE:
             continue
@@ -577,34 +888,33 @@ async def generate_store_stream(
     """Generator that yields SSE events for store generation progress."""
     # Initialize Gemini client
     try:
-        client = genai.Client(api_key=api_key)
+        client = acquire_gemini_client(api_key)
     except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'message': f'Failed to initialize API: {str(e)}'})}\n\n"
+        yield sse_event({'type': 'error', 'message': f'Failed to initialize API: {str(e)}'})
         return
 
-    # Stage 1: Analyzing
-    yield f"data: {json.dumps({'type': 'progress', 'stage': 'analyzing', 'message': 'Analyzing your store description...'})}\n\n"
+    try:
+        # Stage 1: Analyzing
+        yield sse_event({'type': 'progress', 'stage': 'analyzing', 'message': 'Analyzing your store description...'})
 
-    # Build prompt
-    prompt_text = get_store_generation_prompt(description, product_count)
+        # Build prompt
+        prompt_text = get_store_generation_prompt(description, product_count)
 
-    # Create content parts
-    content_parts = [types.Part.from_text(text=prompt_text)]
+        # Create content parts
+        content_parts = [types.Part.from_text(text=prompt_text)]
 
-    # Add file parts if any
-    if file_parts:
-        yield f"data: {json.dumps({'type': 'progress', 'stage': 'analyzing', 'message': f'Processing {len(file_parts)} reference file(s)...'})}\n\n"
-        content_parts.extend(file_parts)
+        # Add file parts if any
+        if file_parts:
+            yield sse_event({'type': 'progress', 'stage': 'analyzing', 'message': f'Processing {len(file_parts)} reference file(s)...'})
+            content_parts.extend(file_parts)
 
-    # Stage 2: Generating
-    yield f"data: {json.dumps({'type': 'progress', 'stage': 'generating', 'message': 'Creating brand concept and product catalog...'})}\n\n"
+        # Stage 2: Generating
+        yield sse_event({'type': 'progress', 'stage': 'generating', 'message': 'Creating brand concept and product catalog...'})
 
-    try:
-        # Generate store concept
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: client.models.generate_content(
+        try:
+            # Generate store concept
+            response = await asyncio.to_thread(
+                client.models.generate_content,
                 model=GEMINI_TEXT_MODEL,
                 contents=[
                     types.Content(
@@ -616,41 +926,41 @@ async def generate_store_stream(
                     response_mime_type="application/json",
                 ),
             )
-        )
 
-        # Parse response
-        response_text = response.text.strip()
+            # Parse response
+            response_text = response.text.strip()
 
-        # Try to parse JSON
-        try:
-            store_data = json.loads(response_text)
-        except json.JSONDecodeError:
-            # Try to extract JSON from response
-            import re
-            json_match = re.search(r'\{[\s\S]*\}', response_text)
-            if json_match:
-                store_data = json.loads(json_match.group())
-            else:
-                raise ValueError("Could not parse response as JSON")
+            # Try to parse JSON
+            try:
+                store_data = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
+                # Fall back to the outermost {...} span in case the model wrapped the JSON
+                start = response_text.find("{")
+                end = response_text.rfind("}")
+                if start == -1 or end < start:
+                    raise ValueError("Could not parse response as JSON")
+                store_data = orjson.loads(response_text[start:end + 1])
 
-        # Validate structure
-        if "brand" not in store_data or "products" not in store_data:
-            raise ValueError("Response missing required 'brand' or 'products' fields")
+            # Validate structure
+            if "brand" not in store_data or "products" not in store_data:
+                raise ValueError("Response missing required 'brand' or 'products' fields")
 
-        # Send brand data
-        yield f"data: {json.dumps({'type': 'brand', 'data': store_data['brand']})}\n\n"
+            # Send brand data
+            yield sse_event({'type': 'brand', 'data': store_data['brand']})
 
-        # Small delay for UX
-        await asyncio.sleep(0.5)
+            # Small delay for UX
+            await asyncio.sleep(0.5)
 
-        # Send products data
-        yield f"data: {json.dumps({'type': 'products', 'data': store_data['products']})}\n\n"
+            # Send products data
+            yield sse_event({'type': 'products', 'data': store_data['products']})
 
-        # Complete
-        yield f"data: {json.dumps({'type': 'complete'})}\n\n"
+            # Complete
+            yield sse_event({'type': 'complete'})
 
-    except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'message': f'Failed to generate store: {str(e)}'})}\n\n"
+        except Exception as e:
+            yield sse_event({'type': 'error', 'message': f'Failed to generate store: {str(e)}'})
+    finally:
+        release_gemini_client(client)
 
 
 @app.post("/api/generate-store")
@@ -672,15 +982,7 @@ async def generate_store(
     # Process uploaded files
     file_parts = await process_uploaded_files(files)
 
-    return StreamingResponse(
-        generate_store_stream(api_key, description, product_count, file_parts),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    return sse_response(generate_store_stream(api_key, description, product_count, file_parts))
 
 
 class ProductsRequest(BaseModel):
@@ -693,8 +995,7 @@ class ProductsRequest(BaseModel):
 def build_product_prompt(product: dict, photo_style: str) -> str:
     """Build a complete prompt for image generation by combining product details with photo style."""
     # Get gender description
-    gender_map = {"M": "men's", "W": "women's", "U": "unisex"}
-    gender = gender_map.get(product.get("gender_code", "U"), "")
+    gender = GENDER_MAP.get(product.get("gender_code", "U"), "")
 
     # Build product description
     product_name = product.get("product_name", "product")
@@ -710,7 +1011,7 @@ def build_product_prompt(product: dict, photo_style: str) -> str:
 
 
 @app.post("/api/generate-from-products")
-async def generate_from_products(request: ProductsRequest):
+async def generate_from_products(request: ProductsRequest, session_id: str = Depends(get_session_id)):
     """Generate images directly from a products array."""
     # Validate products
     if not request.products:
@@ -742,15 +1043,7 @@ async def generate_from_products(request: ProductsRequest):
     if not valid_products:
         raise HTTPException(status_code=400, detail="No valid products found")
 
-    return StreamingResponse(
-        generate_images_stream(request.api_key, valid_products),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    return sse_response(generate_images_stream(request.api_key, valid_products, session_id))
 
 
 class RegenerateSingleRequest(BaseModel):
@@ -765,38 +1058,42 @@ class RegenerateSingleRequest(BaseModel):
 
 
 @app.post("/api/regenerate-single")
-async def regenerate_single(request: RegenerateSingleRequest):
+async def regenerate_single(request: RegenerateSingleRequest, session_id: str = Depends(get_session_id)):
     """Regenerate a single product image and return JSON."""
     if not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt is required")
 
     try:
-        client = genai.Client(api_key=request.api_key)
+        client = acquire_gemini_client(request.api_key)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to initialize API: {str(e)}")
 
-    image_data, _, gen_error = await generate_single_image(client, request.prompt)
+    try:
+        image_data, _, gen_error = await generate_single_image(
+            client, request.prompt, get_gemini_rate_limiter(request.api_key),
+        )
+    finally:
+        release_gemini_client(client)
 
     if not image_data:
         raise HTTPException(status_code=500, detail=gen_error or "Failed to generate image")
 
     filename = create_filename(request.product_number, request.gender_code, request.color_code)
-    image_b64 = base64.b64encode(image_data).decode("utf-8")
 
-    # Update in-memory storage
-    generated_images[filename] = {
-        "data": image_b64,
+    # Update the session's stored copy
+    await asyncio.to_thread(store_image, session_id, filename, {
+        "data": image_data,
         "product_name": request.product_name,
         "color_name": request.color_name,
         "filename": filename,
-    }
+    })
 
     return {
         "filename": filename,
         "productName": request.product_name,
         "colorName": request.color_name,
         "prompt": request.prompt,
-        "data": image_b64,
+        "data": base64.b64encode(image_data).decode("utf-8"),
     }
 
 
@@ -806,12 +1103,178 @@ async def regenerate_single(request: RegenerateSingleRequest):
 
 SHOPIFY_API_VERSION = "2025-01"
 
+# Max product groups pushed at once (upload -> create -> stock -> publish)
+SHOPIFY_CONCURRENCY = int(os.getenv("SHOPIFY_CONCURRENCY", "6"))
+
+# Client-side throttle for Admin API calls, one bucket per store (Shopify's
+# leaky bucket is per app per store). Starts at a burst of 40 requests refilled
+# at 2/s; once Shopify reports extensions.cost.throttleStatus the bucket tracks
+# its query-cost points instead.
+SHOPIFY_RATE_BUCKET = 40
+SHOPIFY_RATE_REFILL = 2.0
+_shopify_rate_limiters: Dict[str, RateLimiter] = {}
+
+# Last requestedQueryCost reported for each GraphQL document
+_shopify_query_costs: Dict[str, float] = {}
+
+# Products created per aliased productSet request, and how long (seconds) a
+# ready product waits for others to join its batch
+SHOPIFY_PRODUCT_SET_BATCH = 5
+SHOPIFY_PRODUCT_SET_WINDOW = 0.1
+
+# Total tries for a GraphQL request that Shopify rejects as THROTTLED
+SHOPIFY_MAX_ATTEMPTS = 3
+
+# Admin API calls are small and should fail fast on a dead store; synchronous
+# productSet waits for the product (and its media) to be created, so it gets
+# longer. Image uploads use the client's default timeouts.
+SHOPIFY_API_TIMEOUT = 10.0
+SHOPIFY_PRODUCT_SET_TIMEOUT = 60.0
+
+
+class _LazyJson:
+    """Log argument that serializes (and truncates) only when the record is formatted."""
+
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj: Any, limit: int):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return orjson.dumps(self.obj, default=str).decode()[:self.limit]
+
+
+def get_shopify_rate_limiter(store_url: str) -> RateLimiter:
+    """Return the shared rate limiter for a store, creating it on first use."""
+    limiter = _shopify_rate_limiters.get(store_url)
+    if limiter is None:
+        limiter = _shopify_rate_limiters[store_url] = RateLimiter(
+            capacity=SHOPIFY_RATE_BUCKET, refill_rate=SHOPIFY_RATE_REFILL,
+        )
+    return limiter
+
+
+# Online store publication ID per store, as (publication_id, fetched_at)
+SHOPIFY_PUBLICATION_TTL = 600.0
+_shopify_publications: Dict[str, tuple] = {}
+
+# Primary inventory location ID per store, as (location_id, fetched_at)
+SHOPIFY_LOCATION_TTL = 3600.0
+_shopify_locations: Dict[str, tuple] = {}
+
+# Admin API documents, built once at import time
+SHOP_NAME_QUERY = "{ shop { name } }"
+SHOP_QUERY = "{ shop { id name } }"
+LOCATIONS_QUERY = "{ locations(first: 5) { nodes { id name isActive } } }"
+
+STAGED_UPLOADS_CREATE_MUTATION = """
+mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets {
+      url
+      resourceUrl
+      parameters {
+        name
+        value
+      }
+    }
+    userErrors {
+      field
+      message
+    }
+  }
+}
+"""
+
+# Selection set for each (aliased) productSet field
+PRODUCT_SET_SELECTION = """
+    product {
+      id
+      title
+      handle
+      variants(first: 50) {
+        nodes {
+          id
+          title
+          sku
+          inventoryItem {
+            id
+          }
+        }
+      }
+    }
+    userErrors {
+      field
+      message
+      code
+    }
+"""
+
+INVENTORY_SET_QUANTITIES_MUTATION = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    inventoryAdjustmentGroup { createdAt }
+    userErrors { field message }
+  }
+}
+"""
+
+PUBLICATIONS_QUERY = """
+{
+  publications(first: 10) {
+    nodes {
+      id
+      name
+      supportsFuturePublishing
+    }
+  }
+}
+"""
+
+PUBLISHABLE_PUBLISH_MUTATION = """
+mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
+  publishablePublish(id: $id, input: $input) {
+    userErrors {
+      field
+      message
+    }
+  }
+}
+"""
+
+
+@lru_cache(maxsize=None)
+def inventory_activate_mutation(count: int) -> str:
+    """Build an inventoryActivate mutation with one aliased field per item ($item0..$itemN)."""
+    item_params = ", ".join(f"$item{i}: ID!" for i in range(count))
+    activations = "\n".join(
+        f"  a{i}: inventoryActivate(inventoryItemId: $item{i}, locationId: $locationId) {{\n"
+        f"    inventoryLevel {{ id }}\n"
+        f"    userErrors {{ field message }}\n"
+        f"  }}"
+        for i in range(count)
+    )
+    return f"mutation inventoryActivate($locationId: ID!, {item_params}) {{\n{activations}\n}}"
+
+
+@lru_cache(maxsize=None)
+def product_set_mutation(count: int) -> str:
+    """Build a productSet mutation with one aliased field per product ($i0..$iN -> p0..pN)."""
+    input_params = ", ".join(f"$i{i}: ProductSetInput!" for i in range(count))
+    fields = "\n".join(
+        f"  p{i}: productSet(input: $i{i}, synchronous: $synchronous) {{{PRODUCT_SET_SELECTION}  }}"
+        for i in range(count)
+    )
+    return f"mutation productSet($synchronous: Boolean!, {input_params}) {{\n{fields}\n}}"
+
 
 class ShopifyValidateRequest(BaseModel):
     """Request model for validating Shopify credentials."""
     store_url: str
     client_id: str
     client_secret: str
+    verify: bool = False  # also query the shop (returns shop_name) after the token exchange
 
 
 async def exchange_shopify_credentials(
@@ -829,6 +1292,7 @@ async def exchange_shopify_credentials(
             "client_secret": client_secret,
         },
         headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=SHOPIFY_API_TIMEOUT,
     )
     resp.raise_for_status()
     return resp.json()["access_token"]
@@ -843,16 +1307,19 @@ async def validate_shopify(request: ShopifyValidateRequest):
     if not store_url or not request.client_id.strip() or not request.client_secret.strip():
         raise HTTPException(status_code=400, detail="Store URL, Client ID, and Client Secret are required")
 
+    client = app.state.http
+    result = None
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # Exchange client credentials for an access token
-            access_token = await exchange_shopify_credentials(
-                client, store_url, request.client_id.strip(), request.client_secret.strip(),
-            )
-            # Verify the token works by querying the shop
+        # Exchange client credentials for an access token; a successful grant
+        # already proves the store URL and credentials are valid
+        access_token = await exchange_shopify_credentials(
+            client, store_url, request.client_id.strip(), request.client_secret.strip(),
+        )
+        if request.verify:
+            # Optionally confirm the token works by querying the shop
             result = await shopify_graphql(
                 client, store_url, access_token,
-                "{ shop { name } }",
+                SHOP_NAME_QUERY,
             )
     except httpx.HTTPStatusError as e:
         if e.response.status_code in (401, 403):
@@ -871,6 +1338,9 @@ async def validate_shopify(request: ShopifyValidateRequest):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Connection failed: {str(e)}")
 
+    if result is None:
+        return {"ok": True, "store_url": store_url}
+
     errors = result.get("errors")
     if errors:
         raise HTTPException(status_code=400, detail=errors[0].get("message", "GraphQL error"))
@@ -890,29 +1360,76 @@ class ShopifyPushRequest(BaseModel):
     location_id: Optional[str] = None  # Shopify location ID (numeric) for inventory
 
 
+class VariantData(NamedTuple):
+    """One color variant of a product being pushed to Shopify."""
+    color_name: str
+    price: str
+    sku: str
+    inventory: int
+
+
+class MediaRef(NamedTuple):
+    """An uploaded image, referenced by its staged-upload resource URL."""
+    resource_url: str
+    alt: str
+
+
 async def shopify_graphql(
     client: httpx.AsyncClient,
     store_url: str,
     access_token: str,
     query: str,
     variables: Optional[dict] = None,
+    timeout: float = SHOPIFY_API_TIMEOUT,
 ) -> dict:
-    """Execute a Shopify GraphQL Admin API request."""
+    """Execute a Shopify GraphQL Admin API request.
+
+    Requests rejected as THROTTLED never ran, so they are retried (up to
+    ``SHOPIFY_MAX_ATTEMPTS`` times) once the bucket has refilled enough to
+    cover their cost.
+    """
     url = f"https://{store_url}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"
     payload = {"query": query}
     if variables:
         payload["variables"] = variables
+    body = orjson.dumps(payload)
+
+    limiter = get_shopify_rate_limiter(store_url)
+    for attempt in range(SHOPIFY_MAX_ATTEMPTS):
+        await limiter.acquire(min(_shopify_query_costs.get(query, 1.0), limiter.capacity))
+        resp = await client.post(
+            url,
+            content=body,
+            headers={
+                "X-Shopify-Access-Token": access_token,
+                "Content-Type": "application/json",
+            },
+            timeout=timeout,
+        )
+        resp.raise_for_status()
+        result = orjson.loads(resp.content)
+
+        # Keep the local bucket in step with Shopify's view of it
+        cost = (result.get("extensions") or {}).get("cost") or {}
+        throttle = cost.get("throttleStatus")
+        if throttle:
+            limiter.sync(throttle["currentlyAvailable"], throttle["maximumAvailable"], throttle["restoreRate"])
+        if cost.get("requestedQueryCost"):
+            _shopify_query_costs[query] = cost["requestedQueryCost"]
+
+        throttled = any(
+            (error.get("extensions") or {}).get("code") == "THROTTLED"
+            for error in result.get("errors") or []
+        )
+        if not throttled or attempt == SHOPIFY_MAX_ATTEMPTS - 1:
+            break
 
-    resp = await client.post(
-        url,
-        json=payload,
-        headers={
-            "X-Shopify-Access-Token": access_token,
-            "Content-Type": "application/json",
-        },
-    )
-    resp.raise_for_status()
-    return resp.json()
+        logger.warning("[shopify] Throttled (attempt %d/%d), retrying", attempt + 1, SHOPIFY_MAX_ATTEMPTS)
+        if not throttle:
+            # No bucket state to wait on; back off for one refill interval instead
+            await asyncio.sleep(1.0 / limiter.refill_rate)
+
+    return result
 
 
 async def shopify_staged_upload(
@@ -924,24 +1441,6 @@ async def shopify_staged_upload(
     file_size: int,
 ) -> dict:
     """Create a staged upload target for an image."""
-    query = """
-    mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
-      stagedUploadsCreate(input: $input) {
-        stagedTargets {
-          url
-          resourceUrl
-          parameters {
-            name
-            value
-          }
-        }
-        userErrors {
-          field
-          message
-        }
-      }
-    }
-    """
     variables = {
         "input": [
             {
@@ -954,7 +1453,7 @@ async def shopify_staged_upload(
         ]
     }
 
-    result = await shopify_graphql(client, store_url, access_token, query, variables)
+    result = await shopify_graphql(client, store_url, access_token, STAGED_UPLOADS_CREATE_MUTATION, variables)
     data = result.get("data", {}).get("stagedUploadsCreate", {})
 
     if data.get("userErrors"):
@@ -975,12 +1474,12 @@ async def upload_image_to_staged_target(
     filename: str,
 ) -> str:
     """Upload image binary to the staged target URL. Returns the resourceUrl."""
-    # Build multipart form data from parameters
-    form_data = {}
-    for param in target["parameters"]:
-        form_data[param["name"]] = param["value"]
+    # Multipart form fields from the target's parameters (httpx needs a mapping here)
+    form_data = {param["name"]: param["value"] for param in target["parameters"]}
 
-    # Upload the file
+    # Upload the file. httpx streams multipart bodies part by part and yields
+    # raw bytes as-is, so the image is sent without being copied into a
+    # combined buffer (wrapping it in a file object would only add reads).
     files = {"file": (filename, image_data, mime_type)}
     resp = await client.post(target["url"], data=form_data, files=files)
     resp.raise_for_status()
@@ -988,56 +1487,52 @@ async def upload_image_to_staged_target(
     return target["resourceUrl"]
 
 
-async def create_shopify_product(
+async def stage_and_upload_image(
     client: httpx.AsyncClient,
     store_url: str,
     access_token: str,
+    filename: str,
+    image_bytes: bytes,
+    alt: str,
+) -> MediaRef:
+    """Stage and upload one variant image. Returns a media entry for productSet."""
+    mime_type = "image/jpeg"
+    upload_filename = f"{filename}.jpg"
+
+    logger.warning("[shopify-push] Staging upload for %s (%d bytes)", upload_filename, len(image_bytes))
+    target = await shopify_staged_upload(
+        client, store_url, access_token,
+        upload_filename, mime_type, len(image_bytes),
+    )
+
+    resource_url = await upload_image_to_staged_target(
+        client, target, image_bytes, mime_type, upload_filename,
+    )
+    logger.warning("[shopify-push] Image uploaded: %s", resource_url[:80])
+
+    return MediaRef(resource_url, alt)
+
+
+def build_product_set_input(
     title: str,
     description_html: str,
     vendor: str,
     product_type: str,
-    variants_data: List[dict],
-    media_urls: List[dict],
+    variants_data: List[VariantData],
+    media_urls: List[MediaRef],
 ) -> dict:
-    """Create a product with variants and media using the productSet mutation.
+    """Build the ProductSetInput for a product with color variants and media.
 
     The productSet mutation (unlike productCreate) supports variants, options,
     and file attachments in a single ProductSetInput.
     """
-    query = """
-    mutation productSet($input: ProductSetInput!, $synchronous: Boolean!) {
-      productSet(input: $input, synchronous: $synchronous) {
-        product {
-          id
-          title
-          handle
-          variants(first: 50) {
-            nodes {
-              id
-              title
-              sku
-              inventoryItem {
-                id
-              }
-            }
-          }
-        }
-        userErrors {
-          field
-          message
-          code
-        }
-      }
-    }
-    """
-
     # Build variant inputs
     variant_inputs = []
     for v in variants_data:
         variant_input = {
-            "optionValues": [{"optionName": "Color", "name": v["color_name"]}],
-            "price": str(v.get("price", "0.00")),
-            "sku": v.get("sku", ""),
+            "optionValues": [{"optionName": "Color", "name": v.color_name}],
+            "price": v.price,
+            "sku": v.sku,
             "inventoryItem": {"tracked": True},
         }
         variant_inputs.append(variant_input)
@@ -1046,9 +1541,9 @@ async def create_shopify_product(
     file_inputs = []
     for m in media_urls:
         file_inputs.append({
-            "originalSource": m["resource_url"],
+            "originalSource": m.resource_url,
             "contentType": "IMAGE",
-            "alt": m.get("alt", ""),
+            "alt": m.alt,
         })
 
     product_input = {
@@ -1060,7 +1555,7 @@ async def create_shopify_product(
         "productOptions": [
             {
                 "name": "Color",
-                "values": [{"name": v["color_name"]} for v in variants_data],
+                "values": [{"name": v.color_name} for v in variants_data],
             }
         ],
         "variants": variant_inputs,
@@ -1069,111 +1564,265 @@ async def create_shopify_product(
     if file_inputs:
         product_input["files"] = file_inputs
 
-    variables = {"input": product_input, "synchronous": True}
+    return product_input
+
+
+class ProductSetNotApplied(ValueError):
+    """A productSet input the server did not apply, so it is safe to send again."""
+
+
+async def batch_create_products(
+    client: httpx.AsyncClient,
+    store_url: str,
+    access_token: str,
+    product_inputs: List[dict],
+) -> List[Any]:
+    """Create several products in one request using aliased productSet fields.
+
+    Returns one entry per input, in order: the created product, or a
+    ValueError if that product's creation failed. Only a request that never
+    executed (``data: null`` from a validation or parse failure, or
+    THROTTLED) gets a ProductSetNotApplied for every input; a null alias
+    with an execution error may still have been applied, so it is a plain
+    failure. Transport errors and timeouts are raised: whether the server
+    applied the batch is unknown then.
+    """
+    variables: Dict[str, Any] = {"synchronous": True}
+    for i, product_input in enumerate(product_inputs):
+        variables[f"i{i}"] = product_input
+
+    logger.debug("[shopify] productSet variables: %s", _LazyJson(variables, 500))
+    result = await shopify_graphql(
+        client, store_url, access_token, product_set_mutation(len(product_inputs)), variables,
+        timeout=SHOPIFY_PRODUCT_SET_TIMEOUT * len(product_inputs),
+    )
+    logger.debug("[shopify] productSet response: %s", _LazyJson(result, 1000))
+
+    graphql_errors = result.get("errors") or []
+    throttled = any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in graphql_errors)
+    if result.get("data") is None or throttled:
+        error_msgs = "; ".join(e.get("message", "Unknown error") for e in graphql_errors) or "no data returned"
+        return [ProductSetNotApplied(f"GraphQL error: {error_msgs}") for _ in product_inputs]
+
+    # Top-level GraphQL errors can come with partial data: aliases that did run
+    # still report their product, so each alias is read on its own
+    data = result["data"]
+    products: List[Any] = []
+    for i in range(len(product_inputs)):
+        alias = f"p{i}"
+        payload = data.get(alias) or {}
+
+        if payload.get("userErrors"):
+            errors = "; ".join(e["message"] for e in payload["userErrors"])
+            products.append(ValueError(f"Product creation error: {errors}"))
+        elif payload.get("product"):
+            products.append(payload["product"])
+        elif graphql_errors:
+            # Prefer the errors reported against this alias, if the server gave paths
+            alias_errors = [e for e in graphql_errors if (e.get("path") or [None])[0] == alias]
+            error_msgs = "; ".join(e.get("message", "Unknown error") for e in alias_errors or graphql_errors)
+            products.append(ValueError(f"GraphQL error: {error_msgs}"))
+        else:
+            products.append(ValueError("Product creation returned null — check API version and mutation input"))
 
-    logger.warning("[shopify] productSet variables: %s", json.dumps(variables, default=str)[:500])
-    result = await shopify_graphql(client, store_url, access_token, query, variables)
-    logger.warning("[shopify] productSet response: %s", json.dumps(result, default=str)[:1000])
+    return products
 
-    # Check for top-level GraphQL errors (schema validation failures, etc.)
-    if result.get("errors"):
-        error_msgs = "; ".join(e.get("message", "Unknown error") for e in result["errors"])
-        raise ValueError(f"GraphQL error: {error_msgs}")
 
-    data = result.get("data") or {}
-    payload = data.get("productSet") or {}
+class ProductSetBatcher:
+    """Coalesces concurrent product creations into aliased productSet requests.
+
+    Callers await ``create(product_input)``. Inputs that arrive within
+    ``window`` seconds of each other are sent together, up to ``max_batch``
+    per request. If the server rejected the whole request without running it
+    (e.g. one input failed schema validation), the products are retried one by
+    one so a bad product cannot sink the others. Nothing else is resent, since
+    a product that failed during execution, timed out or hit a transport error
+    may already have been created.
+    """
 
-    if payload.get("userErrors"):
-        errors = "; ".join(e["message"] for e in payload["userErrors"])
-        raise ValueError(f"Product creation error: {errors}")
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        store_url: str,
+        access_token: str,
+        max_batch: int = SHOPIFY_PRODUCT_SET_BATCH,
+        window: float = SHOPIFY_PRODUCT_SET_WINDOW,
+    ):
+        self.client = client
+        self.store_url = store_url
+        self.access_token = access_token
+        self.max_batch = max_batch
+        self.window = window
+        self._pending: List[tuple] = []  # (product_input, future)
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+
+    async def create(self, product_input: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((product_input, future))
+        if len(self._pending) >= self.max_batch:
+            self._spawn(self._send(self._take()))
+        elif self._timer is None:
+            self._timer = self._spawn(self._send_after_window())
+        return await future
+
+    def close(self) -> None:
+        """Cancel in-flight batches (their callers see CancelledError)."""
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _take(self) -> List[tuple]:
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        return batch
+
+    async def _send_after_window(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        while self._pending:
+            await self._send(self._take())
+
+    async def _create(self, inputs: List[dict]) -> List[Any]:
+        try:
+            return await batch_create_products(self.client, self.store_url, self.access_token, inputs)
+        except Exception as e:
+            # Unknown whether Shopify applied the request, so fail rather than risk duplicates
+            return [e] * len(inputs)
 
-    product = payload.get("product")
-    if not product:
-        raise ValueError("Product creation returned null — check API version and mutation input")
+    async def _send(self, batch: List[tuple]) -> None:
+        try:
+            inputs = [product_input for product_input, _ in batch]
+            results = await self._create(inputs)
+
+            if len(batch) > 1:
+                retry = [i for i, result in enumerate(results) if isinstance(result, ProductSetNotApplied)]
+                if retry:
+                    logger.warning(
+                        "[shopify] %d of %d batched products not applied (%s), retrying them individually",
+                        len(retry), len(batch), results[retry[0]],
+                    )
+                for i in retry:
+                    [results[i]] = await self._create([inputs[i]])
 
-    return product
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
 
 
 async def activate_inventory_at_location(
     client: httpx.AsyncClient,
     store_url: str,
     access_token: str,
-    inventory_item_id: str,
+    inventory_items: List[tuple],
     location_id: str,
-    quantity: int,
 ) -> None:
-    """Activate an inventory item at a location, then set the available quantity."""
-    # Step 1: Activate (stock) the inventory item at this location
-    activate_query = """
-    mutation inventoryActivate($inventoryItemId: ID!, $locationId: ID!) {
-      inventoryActivate(inventoryItemId: $inventoryItemId, locationId: $locationId) {
-        inventoryLevel { id }
-        userErrors { field message }
-      }
-    }
+    """Activate inventory items at a location, then set their available quantities.
+
+    ``inventory_items`` is a list of ``(inventory_item_id, quantity)`` pairs. All
+    items are activated in one aliased mutation and stocked in one
+    inventorySetQuantities call, so a product costs two round trips regardless
+    of how many variants it has.
     """
-    result = await shopify_graphql(
-        client, store_url, access_token, activate_query,
-        {"inventoryItemId": inventory_item_id, "locationId": location_id},
-    )
-    logger.warning("[shopify] inventoryActivate response: %s", json.dumps(result, default=str)[:500])
-    activate_data = (result.get("data") or {}).get("inventoryActivate") or {}
-    if activate_data.get("userErrors"):
-        logger.warning("[shopify] inventoryActivate userErrors (non-fatal): %s", activate_data["userErrors"])
-
-    # Step 2: Set the available quantity
-    if quantity > 0:
-        set_query = """
-        mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
-          inventorySetQuantities(input: $input) {
-            inventoryAdjustmentGroup { createdAt }
-            userErrors { field message }
-          }
+    if not inventory_items:
+        return
+
+    # Step 1: Activate (stock) every inventory item at this location
+    activate_query = inventory_activate_mutation(len(inventory_items))
+    activate_vars = {"locationId": location_id}
+    for i, (inventory_item_id, _) in enumerate(inventory_items):
+        activate_vars[f"item{i}"] = inventory_item_id
+
+    result = await shopify_graphql(client, store_url, access_token, activate_query, activate_vars)
+    logger.debug("[shopify] inventoryActivate response: %s", _LazyJson(result, 500))
+    for activate_data in (result.get("data") or {}).values():
+        if (activate_data or {}).get("userErrors"):
+            logger.warning("[shopify] inventoryActivate userErrors (non-fatal): %s", activate_data["userErrors"])
+
+    # Step 2: Set the available quantities
+    quantities = [
+        {
+            "inventoryItemId": inventory_item_id,
+            "locationId": location_id,
+            "quantity": quantity,
         }
-        """
+        for inventory_item_id, quantity in inventory_items
+        if quantity > 0
+    ]
+    if quantities:
         set_vars = {
             "input": {
                 "reason": "correction",
                 "name": "available",
                 "ignoreCompareQuantity": True,
-                "quantities": [
-                    {
-                        "inventoryItemId": inventory_item_id,
-                        "locationId": location_id,
-                        "quantity": quantity,
-                    }
-                ],
+                "quantities": quantities,
             }
         }
-        result = await shopify_graphql(client, store_url, access_token, set_query, set_vars)
-        logger.warning("[shopify] inventorySetQuantities response: %s", json.dumps(result, default=str)[:500])
+        result = await shopify_graphql(client, store_url, access_token, INVENTORY_SET_QUANTITIES_MUTATION, set_vars)
+        logger.debug("[shopify] inventorySetQuantities response: %s", _LazyJson(result, 500))
         set_data = (result.get("data") or {}).get("inventorySetQuantities") or {}
         if set_data.get("userErrors"):
             logger.warning("[shopify] inventorySetQuantities userErrors: %s", set_data["userErrors"])
         else:
-            logger.warning("[shopify] Inventory set: item=%s, location=%s, qty=%d", inventory_item_id, location_id, quantity)
+            logger.warning("[shopify] Inventory set: %d items, location=%s", len(quantities), location_id)
 
 
-async def publish_product(
+async def get_primary_location(
     client: httpx.AsyncClient,
     store_url: str,
     access_token: str,
-    product_gid: str,
-) -> None:
-    """Publish a product to the online store sales channel."""
-    # First, get the publication ID for the online store
-    pub_query = """
-    {
-      publications(first: 10) {
-        nodes {
-          id
-          name
-          supportsFuturePublishing
-        }
-      }
-    }
+) -> Optional[str]:
+    """Return the ID of the store's first location, used for stocking inventory.
+
+    Results are cached per store for ``SHOPIFY_LOCATION_TTL`` seconds.
     """
-    pub_result = await shopify_graphql(client, store_url, access_token, pub_query)
+    cached = _shopify_locations.get(store_url)
+    if cached and time.monotonic() - cached[1] < SHOPIFY_LOCATION_TTL:
+        return cached[0]
+
+    loc_result = await shopify_graphql(client, store_url, access_token, LOCATIONS_QUERY)
+    locations = (loc_result.get("data") or {}).get("locations", {}).get("nodes", [])
+    if not locations:
+        # Query was denied or returned empty — fall back to getting location
+        # from an inventory item on an existing product
+        logger.warning("[shopify-push] Locations query returned no data (likely ACCESS_DENIED), trying fallback...")
+        fallback_result = await shopify_graphql(client, store_url, access_token, SHOP_QUERY)
+        logger.debug("[shopify-push] Shop query: %s", _LazyJson(fallback_result, 300))
+        return None
+
+    location_id = locations[0]["id"]
+    logger.warning("[shopify-push] Using location: %s (%s)", locations[0].get("name"), location_id)
+    _shopify_locations[store_url] = (location_id, time.monotonic())
+    return location_id
+
+
+async def get_online_store_publication(
+    client: httpx.AsyncClient,
+    store_url: str,
+    access_token: str,
+) -> Optional[str]:
+    """Return the publication ID for the online store sales channel.
+
+    Falls back to the first publication when there is no online store. Results
+    are cached per store for ``SHOPIFY_PUBLICATION_TTL`` seconds.
+    """
+    cached = _shopify_publications.get(store_url)
+    if cached and time.monotonic() - cached[1] < SHOPIFY_PUBLICATION_TTL:
+        return cached[0]
+
+    pub_result = await shopify_graphql(client, store_url, access_token, PUBLICATIONS_QUERY)
     publications = pub_result.get("data", {}).get("publications", {}).get("nodes", [])
 
     online_store_pub = None
@@ -1186,24 +1835,34 @@ async def publish_product(
         # Fall back to first publication
         online_store_pub = publications[0]["id"]
 
-    if not online_store_pub:
-        return  # No publications available
+    if online_store_pub:
+        _shopify_publications[store_url] = (online_store_pub, time.monotonic())
+    return online_store_pub
 
-    query = """
-    mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
-      publishablePublish(id: $id, input: $input) {
-        userErrors {
-          field
-          message
-        }
-      }
-    }
-    """
+
+async def publish_product(
+    client: httpx.AsyncClient,
+    store_url: str,
+    access_token: str,
+    product_gid: str,
+    publication_id: str,
+) -> None:
+    """Publish a product to the given sales channel publication."""
     variables = {
         "id": product_gid,
-        "input": [{"publicationId": online_store_pub}],
+        "input": [{"publicationId": publication_id}],
     }
-    await shopify_graphql(client, store_url, access_token, query, variables)
+    await shopify_graphql(client, store_url, access_token, PUBLISHABLE_PUBLISH_MUTATION, variables)
+
+
+@contextmanager
+def _timed(totals: Dict[str, float], stage: str) -> Iterator[None]:
+    """Add the wall time spent inside the block to ``totals[stage]``."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        totals[stage] += time.monotonic() - start
 
 
 async def push_to_shopify_stream(request: ShopifyPushRequest):
@@ -1213,183 +1872,228 @@ async def push_to_shopify_stream(request: ShopifyPushRequest):
     store_url = request.store_url.strip()
     products = request.products
     brand = request.brand or {}
-    images_map = request.images  # filename -> base64
+    images_map = request.images  # filename -> base64 image data
 
-    # Group products by ProductNumber
-    from collections import OrderedDict
-    groups: OrderedDict[str, List[dict]] = OrderedDict()
+    # Group products by ProductNumber (dicts keep insertion order)
+    groups: Dict[str, List[dict]] = defaultdict(list)
     for p in products:
         key = p.get("ProductNumber", "")
         if key:
-            groups.setdefault(key, []).append(p)
+            groups[key].append(p)
 
     total_groups = len(groups)
     logger.warning("[shopify-push] Grouped into %d product groups", total_groups)
     if total_groups == 0:
-        yield f"data: {json.dumps({'type': 'error', 'message': 'No valid products to push'})}\n\n"
+        yield sse_event({'type': 'error', 'message': 'No valid products to push'})
         return
 
-    yield f"data: {json.dumps({'type': 'progress', 'current': 0, 'total': total_groups, 'message': 'Connecting to Shopify...'})}\n\n"
+    yield sse_event({'type': 'progress', 'current': 0, 'total': total_groups, 'message': 'Connecting to Shopify...'})
 
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            # Exchange client credentials for an access token
-            try:
-                logger.warning("[shopify-push] Exchanging credentials for %s...", store_url)
-                access_token = await exchange_shopify_credentials(
-                    client, store_url, request.client_id.strip(), request.client_secret.strip(),
-                )
-                logger.warning("[shopify-push] Token obtained (length=%d)", len(access_token))
-            except Exception as e:
-                logger.warning("[shopify-push] Auth failed: %s", e)
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Authentication failed: {str(e)}'})}\n\n"
-                return
+    # Await time per stage, summed across concurrent groups; reported in a
+    # final 'timings' event to guide concurrency tuning
+    timings: Dict[str, float] = defaultdict(float)
+    push_started = time.monotonic()
 
-            # Query the store's primary location (required for setting inventory)
-            location_id = None
-            try:
-                loc_result = await shopify_graphql(
-                    client, store_url, access_token,
-                    "{ locations(first: 5) { nodes { id name isActive } } }",
-                )
-                locations = (loc_result.get("data") or {}).get("locations", {}).get("nodes", [])
-                if locations:
-                    location_id = locations[0]["id"]
-                    logger.warning("[shopify-push] Using location: %s (%s)", locations[0].get("name"), location_id)
-                else:
-                    # Query was denied or returned empty — fall back to getting location
-                    # from an inventory item on an existing product
-                    logger.warning("[shopify-push] Locations query returned no data (likely ACCESS_DENIED), trying fallback...")
-                    fallback_result = await shopify_graphql(
-                        client, store_url, access_token,
-                        "{ shop { id name } }",
-                    )
-                    logger.warning("[shopify-push] Shop query: %s", json.dumps(fallback_result, default=str)[:300])
-            except Exception as e:
-                logger.warning("[shopify-push] Could not fetch locations: %s", e)
+    client = app.state.http
+    try:
+        # Exchange client credentials for an access token
+        try:
+            logger.warning("[shopify-push] Exchanging credentials for %s...", store_url)
+            access_token = await exchange_shopify_credentials(
+                client, store_url, request.client_id.strip(), request.client_secret.strip(),
+            )
+            logger.warning("[shopify-push] Token obtained (length=%d)", len(access_token))
+        except Exception as e:
+            logger.warning("[shopify-push] Auth failed: %s", e)
+            yield sse_event({'type': 'error', 'message': f'Authentication failed: {str(e)}'})
+            return
 
-            # If we still don't have a location, try to get it from the first created product's inventory
-            # by creating a temporary product, reading its inventory level, then deleting it.
-            # For now, use a provided location_id if available in the request.
-            if not location_id and hasattr(request, 'location_id') and request.location_id:
-                location_id = f"gid://shopify/Location/{request.location_id}"
-                logger.warning("[shopify-push] Using provided location_id: %s", location_id)
+        # Resolve the store's primary location (required for setting inventory)
+        location_id = None
+        try:
+            location_id = await get_primary_location(client, store_url, access_token)
+        except Exception as e:
+            logger.warning("[shopify-push] Could not fetch locations: %s", e)
 
-            created_count = 0
+        # If we still don't have a location, try to get it from the first created product's inventory
+        # by creating a temporary product, reading its inventory level, then deleting it.
+        # For now, use a provided location_id if available in the request.
+        if not location_id and hasattr(request, 'location_id') and request.location_id:
+            location_id = f"gid://shopify/Location/{request.location_id}"
+            logger.warning("[shopify-push] Using provided location_id: %s", location_id)
 
-            for idx, (product_number, variants) in enumerate(groups.items()):
+        # Resolve the sales channel once; every product is published to it
+        publication_id = None
+        try:
+            publication_id = await get_online_store_publication(client, store_url, access_token)
+        except Exception as e:
+            logger.warning("[shopify-push] Could not fetch publications: %s", e)
+
+        timings["setup"] = time.monotonic() - push_started
+        created_count = 0
+        finished = 0
+        events: asyncio.Queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(SHOPIFY_CONCURRENCY)
+        batcher = ProductSetBatcher(client, store_url, access_token)
+
+        def emit(payload: dict) -> None:
+            events.put_nowait(sse_event(payload))
+
+        async def push_group(variants: List[dict]) -> None:
+            """Upload, create, stock and publish one product, reporting progress via `emit`."""
+            nonlocal created_count, finished
+            async with semaphore:
                 first = variants[0]
                 title = first.get("ProductName", "Untitled")
 
-                yield f"data: {json.dumps({'type': 'progress', 'current': idx + 1, 'total': total_groups, 'message': f'Creating {title}... Uploading images...'})}\n\n"
+                emit({'type': 'progress', 'current': min(finished + 1, total_groups), 'total': total_groups, 'message': f'Creating {title}... Uploading images...'})
 
-                # Upload images for all variants via staged uploads
-                media_urls = []
+                # Upload images for all variants via staged uploads (concurrently, order preserved)
+                uploads = []
                 for variant in variants:
-                    pn = str(variant.get("ProductNumber", "")).replace("-", "")
-                    gc = variant.get("GenderCode", "U")
-                    cc = variant.get("ColorCode", "")
-                    filename = f"{pn}{gc}{cc}"
+                    filename = create_filename(
+                        str(variant.get("ProductNumber", "")),
+                        variant.get("GenderCode", "U"),
+                        variant.get("ColorCode", ""),
+                    )
 
                     image_b64 = images_map.get(filename)
                     if not image_b64:
                         logger.warning("[shopify-push] No image for %s, skipping", filename)
-                        yield f"data: {json.dumps({'type': 'error', 'message': f'No image found for variant {filename}, skipping image.'})}\n\n"
+                        emit({'type': 'error', 'message': f'No image found for variant {filename}, skipping image.'})
                         continue
 
+                    # Decode off the event loop (images run to several MB each); a
+                    # malformed image only skips that image, not the whole push
                     try:
-                        image_bytes = base64.b64decode(image_b64)
-                        mime_type = "image/jpeg"
-                        upload_filename = f"{filename}.jpg"
-
-                        logger.warning("[shopify-push] Staging upload for %s (%d bytes)", upload_filename, len(image_bytes))
-                        target = await shopify_staged_upload(
-                            client, store_url, access_token,
-                            upload_filename, mime_type, len(image_bytes),
-                        )
-
-                        resource_url = await upload_image_to_staged_target(
-                            client, target, image_bytes, mime_type, upload_filename,
-                        )
-                        logger.warning("[shopify-push] Image uploaded: %s", resource_url[:80])
-
-                        media_urls.append({
-                            "resource_url": resource_url,
-                            "alt": f"{variant.get('ProductName', '')} - {variant.get('ColorName', '')}",
-                        })
-                    except Exception as e:
-                        logger.warning("[shopify-push] Image upload failed for %s: %s", filename, e)
-                        yield f"data: {json.dumps({'type': 'error', 'message': f'Image upload failed for {filename}: {str(e)}'})}\n\n"
+                        image_bytes = await asyncio.to_thread(binascii.a2b_base64, image_b64)
+                    except (binascii.Error, ValueError) as e:
+                        logger.warning("[shopify-push] Invalid image data for %s: %s", filename, e)
+                        emit({'type': 'error', 'message': f'Invalid image data for {filename}: {str(e)}, skipping image.'})
+                        continue
+
+                    alt = f"{variant.get('ProductName', '')} - {variant.get('ColorName', '')}"
+                    uploads.append((filename, image_bytes, alt))
+
+                with _timed(timings, "upload"):
+                    results = await asyncio.gather(
+                        *(
+                            stage_and_upload_image(client, store_url, access_token, filename, image_bytes, alt)
+                            for filename, image_bytes, alt in uploads
+                        ),
+                        return_exceptions=True,
+                    )
+
+                media_urls = []
+                for (filename, _, _), result in zip(uploads, results):
+                    if isinstance(result, BaseException):
+                        logger.warning("[shopify-push] Image upload failed for %s: %s", filename, result)
+                        emit({'type': 'error', 'message': f'Image upload failed for {filename}: {str(result)}'})
+                        continue
+                    media_urls.append(result)
 
                 # Build variant data
                 variants_data = []
                 for variant in variants:
                     sku = f"{variant.get('ProductNumber', '')}-{variant.get('ColorCode', 'DEF')}"
                     inventory = int(variant.get("Inventory", 0)) if str(variant.get("Inventory", "")).strip() else 0
-                    variants_data.append({
-                        "color_name": variant.get("ColorName", "Default"),
-                        "price": str(variant.get("Price", "0.00")),
-                        "sku": sku,
-                        "inventory": inventory,
-                    })
+                    variants_data.append(VariantData(
+                        color_name=variant.get("ColorName", "Default"),
+                        price=str(variant.get("Price", "0.00")),
+                        sku=sku,
+                        inventory=inventory,
+                    ))
 
                 # Create the product
                 try:
-                    yield f"data: {json.dumps({'type': 'progress', 'current': idx + 1, 'total': total_groups, 'message': f'Creating {title}...'})}\n\n"
+                    emit({'type': 'progress', 'current': min(finished + 1, total_groups), 'total': total_groups, 'message': f'Creating {title}...'})
 
                     description = first.get("Description", "")
                     description_html = f"<p>{description}</p>" if description else ""
                     product_type = first.get("ProductType", "")
 
                     logger.warning("[shopify-push] Creating product '%s' with %d variants, %d images", title, len(variants_data), len(media_urls))
-                    product = await create_shopify_product(
-                        client, store_url, access_token,
-                        title=title,
-                        description_html=description_html,
-                        vendor=brand.get("name", ""),
-                        product_type=product_type,
-                        variants_data=variants_data,
-                        media_urls=media_urls,
-                    )
+                    with _timed(timings, "create"):
+                        product = await batcher.create(build_product_set_input(
+                            title=title,
+                            description_html=description_html,
+                            vendor=brand.get("name", ""),
+                            product_type=product_type,
+                            variants_data=variants_data,
+                            media_urls=media_urls,
+                        ))
                     logger.warning("[shopify-push] Product created: id=%s, handle=%s", product.get("id"), product.get("handle"))
 
-                    # Activate inventory at the location for each variant
+                    # Activate inventory at the location for all variants in one batch
                     if location_id:
                         created_variants = (product.get("variants") or {}).get("nodes") or []
+                        inventory_items = []
                         for vi, cv in enumerate(created_variants):
                             inv_item_id = (cv.get("inventoryItem") or {}).get("id")
-                            qty = variants_data[vi]["inventory"] if vi < len(variants_data) else 0
+                            qty = variants_data[vi].inventory if vi < len(variants_data) else 0
                             if inv_item_id:
-                                try:
-                                    await activate_inventory_at_location(
-                                        client, store_url, access_token,
-                                        inv_item_id, location_id, qty,
-                                    )
-                                except Exception as inv_err:
-                                    logger.warning("[shopify-push] Inventory activation failed for %s: %s", cv.get("sku"), inv_err)
+                                inventory_items.append((inv_item_id, qty))
+                        try:
+                            with _timed(timings, "inventory"):
+                                await activate_inventory_at_location(
+                                    client, store_url, access_token,
+                                    inventory_items, location_id,
+                                )
+                        except Exception as inv_err:
+                            logger.warning("[shopify-push] Inventory activation failed for %s: %s", title, inv_err)
 
                     product_gid = product.get("id")
-                    if product_gid:
+                    if product_gid and publication_id:
                         try:
-                            await publish_product(client, store_url, access_token, product_gid)
+                            with _timed(timings, "publish"):
+                                await publish_product(client, store_url, access_token, product_gid, publication_id)
                             logger.warning("[shopify-push] Published %s", product_gid)
                         except Exception as pub_err:
                             logger.warning("[shopify-push] Publish failed (non-fatal): %s", pub_err)
 
                     created_count += 1
-                    yield f"data: {json.dumps({'type': 'product_created', 'title': title, 'handle': product.get('handle', ''), 'current': idx + 1, 'total': total_groups})}\n\n"
+                    finished += 1
+                    emit({'type': 'product_created', 'title': title, 'handle': product.get('handle', ''), 'current': finished, 'total': total_groups})
 
                 except Exception as e:
                     logger.warning("[shopify-push] Failed to create %s: %s", title, e)
-                    yield f"data: {json.dumps({'type': 'error', 'message': f'Failed to create {title}: {str(e)}'})}\n\n"
-
-                # Rate limiting: ~2 requests/sec for GraphQL
-                if idx < total_groups - 1:
-                    await asyncio.sleep(1.0)
+                    emit({'type': 'error', 'message': f'Failed to create {title}: {str(e)}'})
+                    finished += 1
 
-        yield f"data: {json.dumps({'type': 'complete', 'created': created_count, 'total': total_groups})}\n\n"
+        async def push_all_groups() -> None:
+            try:
+                results = await asyncio.gather(
+                    *(push_group(variants) for variants in groups.values()),
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.warning("[shopify-push] Product group failed: %s", result)
+                        emit({'type': 'error', 'message': f'Product push failed: {str(result)}'})
+            finally:
+                events.put_nowait(None)  # end of stream
+
+        # Product groups are independent, so run up to SHOPIFY_CONCURRENCY pipelines at
+        # once (the per-store rate limiter still paces the actual API calls)
+        runner = asyncio.create_task(push_all_groups())
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+            await runner
+        finally:
+            runner.cancel()
+            batcher.close()
+
+        timings["total"] = time.monotonic() - push_started
+        stage_timings = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+        logger.warning("[shopify-push] Stage timings (s): %s", stage_timings)
+        yield sse_event({'type': 'timings', **stage_timings})
+        yield sse_event({'type': 'complete', 'created': created_count, 'total': total_groups})
     except Exception as e:
-        yield f"data: {json.dumps({'type': 'error', 'message': f'Shopify connection failed: {str(e)}'})}\n\n"
+        yield sse_event({'type': 'error', 'message': f'Shopify connection failed: {str(e)}'})
 
 
 @app.post("/api/push-to-shopify")
@@ -1402,15 +2106,7 @@ async def push_to_shopify(request: ShopifyPushRequest):
     if not request.products:
         raise HTTPException(status_code=400, detail="Products array is required")
 
-    return StreamingResponse(
-        push_to_shopify_stream(request),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    return sse_response(push_to_shopify_stream(request))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+"""Tests for batched productSet creation in the Shopify push."""
+
+import asyncio
+
+import httpx
+
+import main
+
+
+def run_batch(monkeypatch, responses, inputs):
+    """Push `inputs` through one ProductSetBatcher against canned GraphQL responses.
+
+    `responses` is called with each request's variables and returns the GraphQL
+    result (or raises). Returns (the input ids sent per request, per-product outcomes).
+    """
+    calls = []
+
+    async def fake_graphql(client, store_url, access_token, query, variables=None, timeout=None):
+        sent = [variables[f"i{i}"]["id"] for i in range(len(variables) - 1)]
+        calls.append(sent)
+        return responses(sent)
+
+    monkeypatch.setattr(main, "shopify_graphql", fake_graphql)
+
+    async def push():
+        batcher = main.ProductSetBatcher(None, "example.myshopify.com", "token", max_batch=len(inputs))
+        return await asyncio.gather(*(batcher.create(product_input) for product_input in inputs),
+                                    return_exceptions=True)
+
+    return calls, asyncio.run(push())
+
+
+def created(product_id):
+    return {"product": {"id": f"gid://shopify/Product/{product_id}"}, "userErrors": []}
+
+
+def test_partial_data_with_errors_is_not_resent(monkeypatch):
+    def responses(sent):
+        # p0 ran and created its product; p1 hit an execution error and may have been applied
+        return {
+            "data": {"p0": created("p0"), "p1": None},
+            "errors": [{"message": "Internal error", "path": ["p1"]}],
+        }
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"]]
+    assert results[0] == created("p0")["product"]
+    assert isinstance(results[1], ValueError)
+    assert not isinstance(results[1], main.ProductSetNotApplied)
+    assert "Internal error" in str(results[1])
+
+
+def test_throttled_batch_retries_each_product(monkeypatch):
+    def responses(sent):
+        if len(sent) > 1:
+            return {"data": None, "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}]}
+        return {"data": {"p0": created(sent[0])}}
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"], ["p0"], ["p1"]]
+    assert results == [created("p0")["product"], created("p1")["product"]]
+
+
+def test_unapplied_product_that_fails_again_reports_the_error(monkeypatch):
+    def responses(sent):
+        if sent == ["p0"]:
+            return {"data": {"p0": created("p0")}}
+        return {"data": None, "errors": [{"message": "Variable $i0 was provided invalid value"}]}
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"], ["p0"], ["p1"]]
+    assert results[0] == created("p0")["product"]
+    assert isinstance(results[1], main.ProductSetNotApplied)
+    assert "invalid value" in str(results[1])
+
+
+def test_user_errors_are_not_resent(monkeypatch):
+    def responses(sent):
+        return {"data": {
+            "p0": created("p0"),
+            "p1": {"product": None, "userErrors": [{"field": ["title"], "message": "Title is taken"}]},
+        }}
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"]]
+    assert results[0] == created("p0")["product"]
+    assert "Title is taken" in str(results[1])
+
+
+def test_timeout_fails_the_batch_without_resending(monkeypatch):
+    def responses(sent):
+        raise httpx.ReadTimeout("timed out")
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"]]
+    assert all(isinstance(result, httpx.ReadTimeout) for result in results)
+
+
+def test_validation_failure_without_data_retries_each_product(monkeypatch):
+    def responses(sent):
+        if len(sent) > 1:
+            return {"errors": [{"message": "Variable $i1 of type ProductSetInput! was provided invalid value"}]}
+        return {"data": {"p0": created(sent[0])}}
+
+    calls, results = run_batch(monkeypatch, responses, [{"id": "p0"}, {"id": "p1"}])
+
+    assert calls == [["p0", "p1"], ["p0"], ["p1"]]
+    assert results == [created("p0")["product"], created("p1")["product"]]
+
@@ -15,6 +15,18 @@ import { generateShopifyCsv } from './lib/shopifyCsv';
 
 const API_BASE = 'http://localhost:8000';
 
+// Scopes this browser's generated images in the backend image cache
+function getSessionId() {
+  let sessionId = window.localStorage.getItem('pf-session-id');
+  if (!sessionId) {
+    sessionId = crypto.randomUUID();
+    window.localStorage.setItem('pf-session-id', sessionId);
+  }
+  return sessionId;
+}
+
+const SESSION_HEADERS = { 'X-Session-Id': getSessionId() };
+
 export default function App() {
   // Shared state (apiKey uses sessionStorage for security - clears when tab closes)
   const [apiKey, setApiKey] = useSessionStorage('pf-api-key', '');
@@ -159,6 +171,7 @@ export default function App() {
 
       const response = await fetch(`${API_BASE}/api/generate`, {
         method: 'POST',
+        headers: SESSION_HEADERS,
         body: formData,
         signal: controller.signal,
       });
@@ -241,7 +254,7 @@ export default function App() {
 
   const handleDownloadAll = useCallback(async () => {
     try {
-      const response = await fetch(`${API_BASE}/api/download-all`);
+      const response = await fetch(`${API_BASE}/api/download-all`, { headers: SESSION_HEADERS });
       if (!response.ok) throw new Error('Download failed');
 
       const blob = await response.blob();
@@ -476,7 +489,7 @@ export default function App() {
     try {
       const response = await fetch(`${API_BASE}/api/generate-from-products`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...SESSION_HEADERS },
         body: JSON.stringify({
           api_key: apiKey,
           products,
@@ -609,7 +622,7 @@ export default function App() {
     try {
       const response = await fetch(`${API_BASE}/api/regenerate-single`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...SESSION_HEADERS },
         body: JSON.stringify({
           api_key: apiKey,
           product_number: image.productNumber,
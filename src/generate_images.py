@@ -6,28 +6,70 @@ This script reads product data from a CSV file and generates professional
 product images using Google's Gemini AI model.
 
 Requirements:
-- ffmpeg installed for PNG to JPG conversion
 - CSV file must be in ../data/image_sheet.csv relative to this script
+- ffmpeg (optional) as a fallback for images Pillow can't convert
+
+Generated images are also cached by prompt hash in ../output/.cache, so
+re-runs and renamed products don't regenerate identical prompts.
 
 Usage:
-    python generate_images.py
+    python generate_images.py [--concurrency N] [--no-cache] [--no-dedupe] [--rpm N] [--quality Q]
 """
 
+import argparse
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
-import subprocess
+import queue
+import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, NamedTuple, Optional, Set
 
 import pandas as pd
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
-# Model configuration
-GEMINI_MODEL = "gemini-2.5-flash-image-preview"
+from image_pipeline import (
+    DEFAULT_JPEG_QUALITY,
+    RateLimiter,
+    add_generation_args,
+    create_http_client,
+    create_rate_limiter,
+    generate_image,
+    link_or_copy,
+)
+
+# CSV columns and the product keys they're loaded into
+CSV_COLUMNS = {
+    'ProductNumber': 'product_number',
+    'GenderCode': 'gender_code',
+    'ColorCode': 'color_code',
+    'ProductName': 'product_name',
+    'ColorName': 'color_name',
+    'FlatLayPrompt': 'prompt',
+}
+CSV_DEFAULTS = {column: '' for column in CSV_COLUMNS} | {'GenderCode': 'U'}
+
+
+class Product(NamedTuple):
+    """One row of the product DataFrame: the CSV_COLUMNS fields, then the filename."""
+    product_number: str
+    gender_code: str
+    color_code: str
+    product_name: str
+    color_name: str
+    prompt: str
+    filename: str
+
+
+# Valid product numbers start with this prefix
+PRODUCT_NUMBER_RE = re.compile(r"CNC-P")
 
 
 def setup_logging() -> logging.Logger:
@@ -39,192 +81,206 @@ def setup_logging() -> logging.Logger:
     # Configure logging
     log_file = logs_dir / f"image_generation_{int(time.time())}.log"
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.FileHandler(log_file),
+        logging.StreamHandler(sys.stdout)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
-    return logging.getLogger(__name__)
+    # Callers only enqueue records; a background thread does the file and console writes
+    log_queue: queue.Queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    return logging.getLogger(__name__)
 
-def save_binary_file(file_path: str, data: bytes) -> bool:
-    """Save binary data to file."""
-    try:
-        with open(file_path, "wb") as f:
-            f.write(data)
-        return True
-    except Exception as e:
-        logging.error(f"Failed to save file {file_path}: {e}")
-        return False
 
+def load_product_data(csv_path: str) -> pd.DataFrame:
+    """Load and validate product data from CSV file.
 
-def load_product_data(csv_path: str) -> List[Dict]:
-    """Load and validate product data from CSV file."""
+    Returns one row per valid product, with the columns renamed to the keys in
+    CSV_COLUMNS plus the output image's `filename` (without extension).
+    """
     logger = logging.getLogger(__name__)
 
     try:
         # Read CSV file
         df = pd.read_csv(csv_path)
-        logger.info(f"Loaded CSV with {len(df)} rows")
-
-        # Filter out invalid rows (like the Google Docs link)
-        valid_products = []
-
-        for index, row in df.iterrows():
-            # Skip rows that don't have proper product numbers
-            if pd.isna(row.get('ProductNumber')) or not str(row['ProductNumber']).startswith('CNC-P'):
-                logger.warning(f"Skipping invalid row {index + 1}: {row.get('ProductNumber', 'N/A')}")
-                continue
-
-            # Skip rows without prompts
-            if pd.isna(row.get('FlatLayPrompt')) or not row['FlatLayPrompt'].strip():
-                logger.warning(f"Skipping row {index + 1} - missing prompt: {row['ProductNumber']}")
-                continue
-
-            # Skip rows with "Gregg" in the first column (unnamed column)
-            first_column_value = str(row.iloc[0]) if len(row) > 0 else ""
-            if "Gregg" in first_column_value:
-                logger.info(f"Skipping row {index + 1} - Gregg row: {row['ProductNumber']}")
-                continue
-
-            valid_products.append({
-                'product_number': str(row['ProductNumber']).strip(),
-                'gender_code': str(row.get('GenderCode', 'U')).strip(),
-                'color_code': str(row.get('ColorCode', '')).strip(),
-                'product_name': str(row.get('ProductName', '')).strip(),
-                'color_name': str(row.get('ColorName', '')).strip(),
-                'prompt': str(row['FlatLayPrompt']).strip()
-            })
-
-        logger.info(f"Found {len(valid_products)} valid products to process")
+        logger.info("Loaded CSV with %s rows", len(df))
+
+        # Missing columns and blank cells fall back to CSV_DEFAULTS ('' or 'U'). Blank
+        # cells used to come through as the string 'nan' (e.g. CNCP1000Unan.jpg), so
+        # images saved under those names by older runs are not matched and get regenerated
+        columns = df.reindex(columns=list(CSV_COLUMNS)).fillna(CSV_DEFAULTS).astype(str)
+        cleaned = columns.apply(lambda column: column.str.strip())
+
+        # Filter out invalid rows (like the Google Docs link) and rows without prompts
+        has_product_number = columns['ProductNumber'].str.match(PRODUCT_NUMBER_RE)
+        has_prompt = cleaned['FlatLayPrompt'].ne('')
+        # Skip rows with "Gregg" in the first column (unnamed column)
+        is_gregg = df.iloc[:, 0].astype(str).str.contains('Gregg', regex=False)
+        mask = has_product_number & has_prompt & ~is_gregg
+
+        skipped = {
+            "invalid product number": (~has_product_number).sum(),
+            "missing prompt": (has_product_number & ~has_prompt).sum(),
+            "Gregg row": (has_product_number & has_prompt & is_gregg).sum(),
+        }
+        for reason, count in skipped.items():
+            if count:
+                logger.warning("Skipping %s rows - %s", count, reason)
+        # Building the list is the expensive part, so only do it when it'll be logged
+        if not mask.all() and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Skipped ProductNumbers: %s", columns.loc[~mask, 'ProductNumber'].tolist())
+
+        valid_products = cleaned.loc[mask].rename(columns=CSV_COLUMNS).reset_index(drop=True)
+
+        # Filename is ProductNumber + GenderCode + ColorCode, with dashes removed
+        valid_products['filename'] = (
+            valid_products['product_number'].str.replace('-', '', regex=False)
+            + valid_products['gender_code']
+            + valid_products['color_code']
+        )
+
+        logger.info("Found %s valid products to process", len(valid_products))
         return valid_products
 
     except Exception as e:
-        logger.error(f"Failed to load CSV file {csv_path}: {e}")
+        logger.error("Failed to load CSV file %s: %s", csv_path, e)
         sys.exit(1)
 
 
-def create_filename(product_number: str, gender_code: str, color_code: str) -> str:
-    """Create filename from ProductNumber + GenderCode + ColorCode, removing dashes."""
-    # Remove dashes from product number and combine with gender and color codes
-    clean_product_number = product_number.replace('-', '')
-    return f"{clean_product_number}{gender_code}{color_code}"
-
-
-def convert_png_to_jpg(png_path: Path, jpg_path: Path) -> bool:
-    """Convert PNG to JPG using ffmpeg."""
-    logger = logging.getLogger(__name__)
-
-    try:
-        subprocess.run(
-            ['ffmpeg', '-i', str(png_path), '-q:v', '2', '-y', str(jpg_path)],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        logger.info(f"Successfully converted {png_path.name} to {jpg_path.name}")
-        return True
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"ffmpeg conversion failed for {png_path.name}: {e.stderr}")
-        return False
-    except FileNotFoundError:
-        logger.error("ffmpeg not found. Please install ffmpeg to enable PNG to JPG conversion.")
-        return False
-    except Exception as e:
-        logger.error(f"Unexpected error during conversion of {png_path.name}: {e}")
-        return False
-
-
-def generate_image(client: genai.Client, prompt: str, filename: str, output_dir: Path, max_retries: int = 3) -> bool:
-    """Generate a single product image.
-
-    Note: Caller should verify the output file doesn't already exist before calling.
+async def process_product(
+    client: genai.Client,
+    product: Product,
+    index: int,
+    total_products: int,
+    output_dir: Path,
+    cache_dir: Optional[Path],
+    existing: Set[str],
+    semaphore: asyncio.Semaphore,
+    executor: ThreadPoolExecutor,
+    renders: Optional[Dict[str, "asyncio.Future[Optional[Path]]"]] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    quality: int = DEFAULT_JPEG_QUALITY,
+) -> str:
+    """Generate the image for one product. Returns "success", "failed" or "skipped".
+
+    With `renders`, only the first product for each prompt calls Gemini; later
+    products with the same prompt wait for that image and link to it.
     """
     logger = logging.getLogger(__name__)
 
+    filename = product.filename
+    if f"{filename}.jpg" in existing:
+        logger.info("Image already exists for %s, skipping", filename)
+        return "skipped"
+
+    logger.info(
+        "Processing %s/%s: %s (%s - %s - %s)",
+        index, total_products, filename,
+        product.product_name, product.gender_code, product.color_name,
+    )
     jpg_file = output_dir / f"{filename}.jpg"
-    png_file = output_dir / f"{filename}.png"
+    prompt = product.prompt
 
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Generating image for {filename} (attempt {attempt + 1}/{max_retries})")
+    render = renders.get(prompt) if renders is not None else None
+    if render is not None:
+        source = await render
+        if source is not None and await asyncio.to_thread(link_or_copy, source, jpg_file):
+            logger.info("Linked %s to %s (same prompt)", filename, source.name)
+            existing.add(jpg_file.name)
+            return "success"
+        # The first render of this prompt failed, so try it ourselves
 
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=prompt)],
-                ),
-            ]
+    if renders is not None and prompt not in renders:
+        render = renders[prompt] = asyncio.get_running_loop().create_future()
 
-            generate_content_config = types.GenerateContentConfig(
-                response_modalities=["IMAGE", "TEXT"],
-            )
+    success = False
+    try:
+        success = await generate_image(
+            client, prompt, filename, output_dir, semaphore, executor, cache_dir, rate_limiter, quality,
+        )
+    finally:
+        if render is not None and not render.done():
+            render.set_result(jpg_file if success else None)
+    if success:
+        existing.add(f"{filename}.jpg")
+
+    return "success" if success else "failed"
+
+
+async def process_products(
+    client: genai.Client,
+    products: pd.DataFrame,
+    output_dir: Path,
+    concurrency: int,
+    cache_dir: Optional[Path] = None,
+    dedupe: bool = True,
+    rpm: float = 0,
+    quality: int = DEFAULT_JPEG_QUALITY,
+) -> Dict[str, int]:
+    """Generate images for all products, at most `concurrency` Gemini requests at a time.
+
+    JPG conversion is CPU-bound, so it runs on its own thread pool sized to the
+    machine rather than sharing the Gemini concurrency limit.
+    """
+    logger = logging.getLogger(__name__)
 
-            response_chunks = list(client.models.generate_content_stream(
-                model=GEMINI_MODEL,
-                contents=contents,
-                config=generate_content_config,
+    semaphore = asyncio.Semaphore(concurrency)
+    rate_limiter = create_rate_limiter(rpm, concurrency)
+    total_products = len(products)
+    counts = {"success": 0, "failed": 0, "skipped": 0}
+
+    # One directory listing up front instead of a stat per product
+    existing = {path.name for path in output_dir.iterdir() if path.suffix == ".jpg"}
+    # First render of each prompt in this run, shared with later products using the same prompt
+    renders: Optional[Dict[str, "asyncio.Future[Optional[Path]]"]] = {} if dedupe else None
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        tasks = [
+            asyncio.create_task(process_product(
+                client, product, i, total_products, output_dir, cache_dir, existing, semaphore, executor,
+                renders, rate_limiter, quality,
             ))
-
-            # Process response chunks
-            image_saved = False
-            for chunk in response_chunks:
-                if (
-                    chunk.candidates is None
-                    or chunk.candidates[0].content is None
-                    or chunk.candidates[0].content.parts is None
-                ):
-                    continue
-
-                part = chunk.candidates[0].content.parts[0]
-                if part.inline_data and part.inline_data.data:
-                    if save_binary_file(str(png_file), part.inline_data.data):
-                        logger.info(f"Successfully generated PNG: {png_file.name}")
-
-                        # Convert PNG to JPG
-                        if convert_png_to_jpg(png_file, jpg_file):
-                            # Remove the temporary PNG file
-                            try:
-                                png_file.unlink()
-                                logger.debug(f"Removed temporary PNG: {png_file.name}")
-                            except Exception as e:
-                                logger.warning(f"Could not remove temporary PNG {png_file.name}: {e}")
-
-                            image_saved = True
-                            break
-                        else:
-                            logger.error(f"Failed to convert {png_file.name} to JPG")
-                            break
-                else:
-                    # Log any text responses
-                    if hasattr(chunk, 'text') and chunk.text:
-                        logger.debug(f"API response text for {filename}: {chunk.text}")
-
-            if image_saved:
-                return True
-            else:
-                logger.warning(f"No image data received for {filename} on attempt {attempt + 1}")
-
-        except Exception as e:
-            logger.error(f"Error generating image for {filename} on attempt {attempt + 1}: {e}")
-
-            if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 5  # Exponential backoff: 5s, 10s, 20s
-                logger.info(f"Waiting {wait_time} seconds before retry...")
-                time.sleep(wait_time)
-
-    logger.error(f"Failed to generate image for {filename} after {max_retries} attempts")
-    return False
+            for i, product in enumerate(map(Product._make, products.itertuples(index=False, name=None)), 1)
+        ]
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            counts[await task] += 1
+
+            # Progress update every 10 items
+            if done % 10 == 0 or done == total_products:
+                logger.info("Progress: %s/%s processed. Success: %s, Failed: %s, Skipped: %s",
+                            done, total_products, counts['success'], counts['failed'], counts['skipped'])
+
+    return counts
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Generate product images from the CSV product sheet.")
+    add_generation_args(parser)
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="Generate a separate image for every product even when prompts repeat "
+             "(combine with --no-cache to also skip cached renders)",
+    )
+    return parser.parse_args()
 
 
 def main() -> None:
     """Main function to orchestrate the image generation process."""
     load_dotenv()
+    args = parse_args()
+    concurrency = max(1, args.concurrency)
 
     logger = setup_logging()
     logger.info("Starting product image generation process")
@@ -240,9 +296,12 @@ def main() -> None:
     project_dir = script_dir.parent
     csv_path = project_dir / "data" / "image_sheet.csv"
     output_dir = project_dir / "output" / "generated_images"
+    cache_dir = None if args.no_cache else project_dir / "output" / ".cache"
 
-    # Create output directory
+    # Create output directories
     output_dir.mkdir(parents=True, exist_ok=True)
+    if cache_dir:
+        cache_dir.mkdir(parents=True, exist_ok=True)
 
     # Validate CSV file exists
     if not csv_path.exists():
@@ -251,60 +310,38 @@ def main() -> None:
 
     # Load product data
     products = load_product_data(str(csv_path))
-    if not products:
+    if products.empty:
         logger.error("No valid products found in CSV file")
         sys.exit(1)
 
     # Initialize Gemini client
+    # All requests share one pooled HTTP/2 connection instead of handshaking per image
+    http_client = create_http_client(concurrency)
     try:
-        client = genai.Client(api_key=api_key)
+        client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(httpx_async_client=http_client),
+        )
         logger.info("Successfully initialized Gemini client")
     except Exception as e:
         logger.error(f"Failed to initialize Gemini client: {e}")
         sys.exit(1)
 
-    # Process each product
+    # Process products concurrently
     total_products = len(products)
-    successful_generations = 0
-    failed_generations = 0
-    skipped_generations = 0
+    logger.info(f"Starting to process {total_products} products ({concurrency} at a time)")
 
-    logger.info(f"Starting to process {total_products} products")
-
-    for i, product in enumerate(products, 1):
-        filename = create_filename(
-            product['product_number'],
-            product['gender_code'],
-            product['color_code'],
-        )
-        logger.info(
-            f"Processing {i}/{total_products}: {filename} "
-            f"({product['product_name']} - {product['gender_code']} - {product['color_name']})"
-        )
+    async def run() -> Dict[str, int]:
+        async with http_client:
+            return await process_products(
+                client, products, output_dir, concurrency, cache_dir,
+                dedupe=not args.no_dedupe, rpm=args.rpm, quality=args.quality,
+            )
 
-        output_file = output_dir / f"{filename}.jpg"
-        if output_file.exists():
-            logger.info(f"Image already exists for {filename}, skipping")
-            skipped_generations += 1
-            continue
-
-        success = generate_image(client, product['prompt'], filename, output_dir)
-
-        if success:
-            successful_generations += 1
-        else:
-            failed_generations += 1
-
-        # Add small delay between requests to be respectful to the API
-        if i < total_products:
-            time.sleep(2)
-
-        # Progress update every 10 items
-        if i % 10 == 0 or i == total_products:
-            logger.info(f"Progress: {i}/{total_products} processed. "
-                       f"Success: {successful_generations}, "
-                       f"Failed: {failed_generations}, "
-                       f"Skipped: {skipped_generations}")
+    counts = asyncio.run(run())
+    successful_generations = counts["success"]
+    failed_generations = counts["failed"]
+    skipped_generations = counts["skipped"]
 
     # Final summary
     logger.info("=" * 60)
@@ -0,0 +1,344 @@
+"""
+Gemini image pipeline shared by the standalone CLI scripts.
+
+Covers requesting images from Gemini (rate limiting, retries, the pooled HTTP
+client), converting them to JPG, and the prompt-hash image cache. Used by
+src/generate_images.py and generate_additional_images.py.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import random
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import httpx
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
+from PIL import Image
+
+# Model configuration
+GEMINI_MODEL = "gemini-2.5-flash-image-preview"
+GENERATE_CONTENT_CONFIG = types.GenerateContentConfig(
+    response_modalities=["IMAGE", "TEXT"],
+)
+
+# Leading bytes of the image formats Gemini returns (PNG, and JPEG just in case)
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")
+
+# Retry backoff cap in seconds, and the 4xx codes worth retrying (timeouts and rate
+# limits); other client errors such as a bad key or permission denied fail immediately
+MAX_BACKOFF = 60
+RETRYABLE_CLIENT_CODES = {408, 429}
+
+# Default number of concurrent Gemini requests (override with --concurrency or GEMINI_CONCURRENCY)
+DEFAULT_CONCURRENCY = 4
+
+# Default JPEG quality (override with --quality); progressive q85 is plenty for ecommerce
+DEFAULT_JPEG_QUALITY = 85
+
+
+def add_generation_args(parser: argparse.ArgumentParser) -> None:
+    """Add the --concurrency, --no-cache, --rpm and --quality options."""
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("GEMINI_CONCURRENCY", DEFAULT_CONCURRENCY)),
+        help=f"Max concurrent Gemini requests (default: $GEMINI_CONCURRENCY or {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call Gemini, ignoring images cached from earlier runs of the same prompt",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=float(os.getenv("GEMINI_RPM", "0")),
+        help="Max Gemini requests per minute, matching your API quota (default: $GEMINI_RPM or 0, no limit)",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=DEFAULT_JPEG_QUALITY,
+        help=f"JPEG quality for saved images, 1-95 (default: {DEFAULT_JPEG_QUALITY})",
+    )
+
+
+def convert_png_to_jpg(png_data: bytes, jpg_path: Path, quality: int = DEFAULT_JPEG_QUALITY) -> bool:
+    """Convert PNG bytes to a progressive JPG file in-process using Pillow."""
+    logger = logging.getLogger(__name__)
+
+    try:
+        with Image.open(io.BytesIO(png_data)) as image:
+            image.convert("RGB").save(
+                jpg_path,
+                format="JPEG",
+                quality=quality,
+                progressive=True,
+                optimize=True,
+                subsampling="4:2:0",
+            )
+        logger.info("Successfully converted image to %s", jpg_path.name)
+        return True
+    except Exception as e:
+        logger.error("Pillow conversion failed for %s: %s", jpg_path.name, e)
+        return False
+
+
+def _pipe_to_ffmpeg(png_data: bytes, jpg_path: Path) -> bool:
+    """Convert PNG bytes to JPG by piping them through ffmpeg's stdin (fallback when Pillow can't decode the image)."""
+    logger = logging.getLogger(__name__)
+
+    # One thread per ffmpeg process so concurrent conversions don't oversubscribe the CPU
+    ffmpeg_threads = os.getenv("FFMPEG_THREADS", "1")
+    cmd = ['ffmpeg', '-threads', ffmpeg_threads, '-loglevel', 'error',
+           '-f', 'image2pipe', '-i', 'pipe:0', '-q:v', '2', '-y', str(jpg_path)]
+
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = proc.communicate(input=png_data)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.decode(errors="replace"))
+        logger.info("Successfully converted image to %s with ffmpeg", jpg_path.name)
+        return True
+
+    except subprocess.CalledProcessError as e:
+        logger.error("ffmpeg conversion failed for %s: %s", jpg_path.name, e.stderr)
+        return False
+    except FileNotFoundError:
+        logger.error("ffmpeg not found. Please install ffmpeg to enable PNG to JPG conversion.")
+        return False
+    except Exception as e:
+        logger.error("Unexpected error during conversion to %s: %s", jpg_path.name, e)
+        return False
+
+
+def save_image(png_data: bytes, jpg_path: Path, quality: int = DEFAULT_JPEG_QUALITY) -> bool:
+    """Write PNG bytes out as a JPG, with Pillow first and ffmpeg as the fallback."""
+    return convert_png_to_jpg(png_data, jpg_path, quality) or _pipe_to_ffmpeg(png_data, jpg_path)
+
+
+def prompt_cache_key(prompt: str) -> str:
+    """Content-address a prompt (and the model rendering it) for the image cache."""
+    return hashlib.sha256(f"{GEMINI_MODEL}\n{prompt}".encode()).hexdigest()[:16]
+
+
+def link_or_copy(src: Path, dst: Path) -> bool:
+    """Hard-link src to dst, falling back to a copy (e.g. across filesystems)."""
+    logger = logging.getLogger(__name__)
+
+    try:
+        os.link(src, dst)
+        return True
+    except FileExistsError:
+        return True
+    except OSError:
+        pass
+
+    try:
+        shutil.copy(src, dst)
+        return True
+    except Exception as e:
+        logger.warning("Could not copy %s to %s: %s", src, dst, e)
+        return False
+
+
+class RateLimiter:
+    """Async token bucket.
+
+    Allows bursts of up to ``capacity`` calls and refills at ``refill_rate``
+    tokens per second. Callers only wait when the bucket is empty.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None  # created lazily inside the running loop
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.refill_rate)
+
+
+def create_rate_limiter(rpm: float, concurrency: int) -> Optional[RateLimiter]:
+    """Token bucket holding requests to `rpm` per minute, or None when rpm is 0 (no limit)."""
+    return RateLimiter(capacity=concurrency, refill_rate=rpm / 60) if rpm > 0 else None
+
+
+def create_http_client(concurrency: int) -> httpx.AsyncClient:
+    """Create the pooled HTTP/2 client shared by every Gemini request in a run."""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+    )
+
+
+def _server_retry_after(error: genai_errors.APIError) -> Optional[float]:
+    """Delay the API asked for, from a Retry-After header or a google.rpc.RetryInfo detail."""
+    headers = getattr(error.response, "headers", None) or {}
+    value = headers.get("Retry-After")
+    if value is None and isinstance(error.details, dict):
+        for detail in error.details.get("error", {}).get("details", []):
+            if detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+                value = str(detail.get("retryDelay", "")).rstrip("s")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying after `error`, or None if retrying won't help."""
+    if isinstance(error, genai_errors.ClientError) and error.code not in RETRYABLE_CLIENT_CODES:
+        return None
+
+    # Exponential backoff plus jitter, so concurrent workers don't retry in lockstep
+    wait_time = min(MAX_BACKOFF, 2 ** attempt) + random.uniform(0, 2 ** attempt)
+    if isinstance(error, genai_errors.ClientError) and error.code == 429:
+        # Honor the server's delay, but never wait longer than MAX_BACKOFF
+        server_delay = _server_retry_after(error)
+        if server_delay:
+            wait_time = min(MAX_BACKOFF, server_delay)
+    return wait_time
+
+
+async def fetch_image(
+    client: genai.Client,
+    prompt: str,
+    filename: str,
+    rate_limiter: Optional[RateLimiter] = None,
+    max_retries: int = 3,
+) -> Optional[bytes]:
+    """Request an image from Gemini, returning the raw PNG bytes of the first image part."""
+    logger = logging.getLogger(__name__)
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=prompt)],
+        ),
+    ]
+
+    for attempt in range(max_retries):
+        try:
+            logger.info("Generating image for %s (attempt %s/%s)", filename, attempt + 1, max_retries)
+
+            if rate_limiter:
+                await rate_limiter.acquire()
+
+            response_stream = await client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=GENERATE_CONTENT_CONFIG,
+            )
+
+            # Process response chunks
+            try:
+                async for chunk in response_stream:
+                    if (
+                        chunk.candidates is None
+                        or chunk.candidates[0].content is None
+                        or chunk.candidates[0].content.parts is None
+                    ):
+                        continue
+
+                    part = chunk.candidates[0].content.parts[0]
+                    if part.inline_data and part.inline_data.data:
+                        # Don't hand corrupt or truncated data to the converters; retry instead
+                        if not part.inline_data.data.startswith(IMAGE_SIGNATURES):
+                            logger.warning("Ignoring image data for %s that isn't a PNG or JPEG", filename)
+                            continue
+                        return part.inline_data.data
+                    else:
+                        # Log any text responses
+                        if hasattr(chunk, 'text') and chunk.text:
+                            logger.debug("API response text for %s: %s", filename, chunk.text)
+            finally:
+                # Close the stream as soon as the image arrives instead of leaving it to the garbage collector
+                await response_stream.aclose()
+
+            logger.warning("No image data received for %s on attempt %s", filename, attempt + 1)
+
+        except Exception as e:
+            logger.error("Error generating image for %s on attempt %s: %s", filename, attempt + 1, e)
+
+            wait_time = retry_delay(e, attempt)
+            if wait_time is None:
+                logger.error("Not retrying %s: the request was rejected", filename)
+                return None
+
+            if attempt < max_retries - 1:
+                logger.info("Waiting %.1f seconds before retry...", wait_time)
+                await asyncio.sleep(wait_time)
+
+    logger.error("Failed to generate image for %s after %s attempts", filename, max_retries)
+    return None
+
+
+async def generate_image(
+    client: genai.Client,
+    prompt: str,
+    filename: str,
+    output_dir: Path,
+    semaphore: asyncio.Semaphore,
+    executor: ThreadPoolExecutor,
+    cache_dir: Optional[Path] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    quality: int = DEFAULT_JPEG_QUALITY,
+    max_retries: int = 3,
+) -> bool:
+    """Generate a single product image as `output_dir/<filename>.jpg`.
+
+    Images are cached in `cache_dir` by prompt hash, so an identical prompt is only
+    ever sent to Gemini once; pass `cache_dir=None` to bypass the cache.
+
+    Note: Caller should verify the output file doesn't already exist before calling.
+    """
+    logger = logging.getLogger(__name__)
+
+    jpg_file = output_dir / f"{filename}.jpg"
+    # Renders at different qualities are cached separately
+    cache_file = cache_dir / f"{prompt_cache_key(prompt)}-q{quality}.jpg" if cache_dir else None
+
+    # Only the Gemini request holds a concurrency slot; conversion runs on the
+    # executor so the next request can start while this image is encoded.
+    async with semaphore:
+        # Checked once we have a slot, so earlier renders of the same prompt get a chance to land
+        if cache_file and cache_file.exists():
+            if await asyncio.to_thread(link_or_copy, cache_file, jpg_file):
+                logger.info("Reused cached image %s for %s", cache_file.name, filename)
+                return True
+
+        png_data = await fetch_image(client, prompt, filename, rate_limiter, max_retries)
+    if png_data is None:
+        return False
+
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(executor, save_image, png_data, jpg_file, quality):
+        logger.error("Failed to convert image for %s to JPG", filename)
+        return False
+
+    if cache_file:
+        await asyncio.to_thread(link_or_copy, jpg_file, cache_file)
+    return True